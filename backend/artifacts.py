@@ -0,0 +1,143 @@
+# Import packages to read & write binary product embedding artifacts
+import hashlib
+import json
+import os
+from datetime import datetime, timezone
+
+import numpy as np
+
+from table_store import atomic_path, file_lock
+
+
+def content_hash(product_id : int, name : str):
+    """Hash of the product fields an embedding is computed from, used to detect new or changed products"""
+    return hashlib.sha1(f"{product_id}\x1f{name}".encode("utf-8")).hexdigest()[:16]
+
+
+class EmbeddingArtifact:
+    """Product embeddings stored as a binary `.npy` matrix plus a `.json` sidecar.
+
+    The sidecar holds a schema header (format, version, model, dtype, shape), the product ids & names aligned with
+    the rows of the matrix, and a content hash manifest of every row used for incremental refreshes. The matrix can
+    be memory-mapped directly instead of parsing a wide CSV.
+    """
+    FORMAT = "product-embeddings"
+    VERSION = 1
+    EXTENSIONS = (".npy", ".json")
+
+    def __init__(self, product_ids, names, embeddings, model_name : str, created_at : str=None, content_hashes : list=None):
+        self.product_ids = np.asarray(product_ids)
+        self.names = list(names)
+        self.content_hashes = content_hashes or [content_hash(product_id, name) for product_id, name in zip(self.product_ids.tolist(), self.names)]
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.created_at = created_at or datetime.now(timezone.utc).isoformat()
+
+        assert len(self.product_ids) == len(self.names) == self.embeddings.shape[0], "Product ids, names and embeddings must have the same number of rows"
+
+    @property
+    def manifest(self):
+        """Dictionary of product id -> content hash of the row it was encoded from"""
+        return dict(zip(self.product_ids.tolist(), self.content_hashes))
+
+    @property
+    def schema(self):
+        return {"format" : self.FORMAT,
+                "version" : self.VERSION,
+                "model" : self.model_name,
+                "dtype" : str(self.embeddings.dtype),
+                "rows" : int(self.embeddings.shape[0]),
+                "dim" : int(self.embeddings.shape[1]),
+                "created_at" : self.created_at}
+
+    def save(self, path : str, dtype : str="float32"):
+        """Save the artifact
+        Args:
+            path (str) – file path without extension, e.g. '/tmp/product_embeddings_all-mpnet-base-v2'
+            dtype (str, optional) – {"float32", "float16"} dtype of the stored matrix. Default: "float32"
+
+        Returns:
+            list – paths of the written files
+        """
+        assert dtype in ("float32", "float16"), f"Unsupported embedding dtype {dtype}"
+        embeddings = np.ascontiguousarray(self.embeddings, dtype=dtype)
+        schema = dict(self.schema, dtype=dtype)
+        sidecar = {"schema" : schema,
+                   "product_ids" : self.product_ids.tolist(),
+                   "names" : self.names,
+                   "content_hashes" : self.content_hashes}
+
+        # Write to temporary files first so readers never see a half-written artifact
+        with open(path + ".npy.tmp", "wb") as f:
+            np.save(f, embeddings, allow_pickle=False)
+        os.replace(path + ".npy.tmp", path + ".npy")
+        with open(path + ".json.tmp", "w") as f:
+            json.dump(sidecar, f)
+        os.replace(path + ".json.tmp", path + ".json")
+
+        return [path + ext for ext in self.EXTENSIONS]
+
+    @classmethod
+    def load(cls, path : str, mmap : bool=True, model_name : str=None):
+        """Load an artifact written by `save`
+        Args:
+            path (str) – file path without extension
+            mmap (bool, optional) – memory-map the embedding matrix read-only instead of reading it into memory. Default: True
+            model_name (str, optional) – expected embedding model, checked against the schema header. Default: None
+
+        Returns:
+            EmbeddingArtifact – artifact whose `embeddings` is a (memory-mapped) array
+        """
+        with open(path + ".json") as f:
+            sidecar = json.load(f)
+        schema = sidecar["schema"]
+        assert schema.get("format") == cls.FORMAT, f"{path}.json is not a {cls.FORMAT} artifact"
+        assert schema.get("version") == cls.VERSION, f"Unsupported {cls.FORMAT} artifact version {schema.get('version')} (expected {cls.VERSION})"
+        assert model_name is None or schema["model"] == model_name, f"Embeddings were created with {schema['model']}, not {model_name}"
+
+        embeddings = np.load(path + ".npy", mmap_mode="r" if mmap else None, allow_pickle=False)
+        assert str(embeddings.dtype) == schema["dtype"], f"Embedding dtype {embeddings.dtype} does not match schema dtype {schema['dtype']}"
+        assert embeddings.shape == (schema["rows"], schema["dim"]), f"Embedding shape {embeddings.shape} does not match schema shape {(schema['rows'], schema['dim'])}"
+
+        return cls(sidecar["product_ids"], sidecar["names"], embeddings, schema["model"], created_at=schema["created_at"],
+                   content_hashes=sidecar.get("content_hashes"))
+
+
+def download_embedding_artifact(source, directory : str, model_name : str):
+    """Download the product embeddings artifact of `model_name` from a data source & memory-map it"""
+    name = f"product_embeddings_{model_name}"
+    os.makedirs(directory, exist_ok=True)
+    with file_lock(os.path.join(directory, name)):   # API workers sharing the directory download one at a time
+        for ext in EmbeddingArtifact.EXTENSIONS:
+            with atomic_path(os.path.join(directory, name + ext)) as tmp_path:   # Never truncates a file another worker has mapped
+                source.download_file(name + ext, tmp_path)
+        return EmbeddingArtifact.load(os.path.join(directory, name), model_name=model_name)
+
+
+def upload_embedding_artifact(source, directory : str, model_name : str):
+    """Upload a saved product embeddings artifact to a data source, sidecar last so readers never pair it with an older matrix"""
+    name = f"product_embeddings_{model_name}"
+    source.upload_file(name + ".npy", os.path.join(directory, name + ".npy"), content_type="application/octet-stream")
+    source.upload_file(name + ".json", os.path.join(directory, name + ".json"), content_type="application/json")
+
+
+def plan_refresh(artifact, product_ids, names):
+    """Find which products' embeddings can be reused from a previous artifact
+    Args:
+        artifact (EmbeddingArtifact) – previous artifact, or None for a full refresh
+        product_ids (list) – ids of the current catalog
+        names (list) – names of the current catalog, aligned with `product_ids`
+
+    Returns:
+        array – for every current product, the row of its unchanged embedding in `artifact`, or -1 if it must be encoded
+    """
+    reuse_rows = np.full(len(product_ids), -1, dtype=np.int64)
+    if artifact is None:
+        return reuse_rows
+
+    manifest = artifact.manifest
+    previous_rows = {product_id : row for row, product_id in enumerate(artifact.product_ids.tolist())}
+    for i, (product_id, name) in enumerate(zip(product_ids, names)):
+        if manifest.get(product_id) == content_hash(product_id, name):
+            reuse_rows[i] = previous_rows[product_id]
+    return reuse_rows
@@ -0,0 +1,236 @@
+# Benchmark the API endpoints & batch jobs against a local (synthetic) dataset
+# Usage: python backend/synthetic-data.py --order-items 1000000 --out data/1m --embeddings
+#        python backend/benchmark.py --data-dir data/1m --output bench-1m.json
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+RFM_TOLERANCE = 1e-6   # Maximum absolute difference between RFM summaries that must be identical up to floating point summation order
+CLV_PARAM_TOLERANCE = 1e-3   # Maximum relative difference between the numpy & lifetimes CLV parameters, both fitted with penalizer 0.01
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process in MB (ru_maxrss is reported in KB on Linux)"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def memory_status_mb(field : str, pid="self"):
+    """Memory field of /proc/<pid>/status in MB, e.g. "VmHWM" (peak RSS) or "VmRSS". None if unavailable or the process exited"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def reset_peak_rss():
+    """Reset the VmHWM high-water mark of this process to its current RSS. Returns False if the kernel doesn't allow it"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def summarize(latencies : list, wall_time : float):
+    latencies_ms = np.asarray(latencies) * 1000
+    return {"requests" : len(latencies_ms),
+            "p50_ms" : float(np.percentile(latencies_ms, 50)),
+            "p90_ms" : float(np.percentile(latencies_ms, 90)),
+            "p99_ms" : float(np.percentile(latencies_ms, 99)),
+            "max_ms" : float(latencies_ms.max()),
+            "mean_ms" : float(latencies_ms.mean()),
+            "throughput_rps" : len(latencies_ms) / wall_time}
+
+
+def timed_stage(results : dict, name : str, func, *args):
+    """Run one batch stage, record its wall time & the peak memory so far"""
+    start_time = time.perf_counter()
+    result = func(*args)
+    results[name] = {"seconds" : time.perf_counter() - start_time, "peak_rss_mb" : peak_rss_mb()}
+    print(f"{name:<40} {results[name]['seconds']:>10.3f} s  {results[name]['peak_rss_mb']:>10.1f} MB")
+    return result
+
+
+def bench_endpoint(client, path : str, params_list : list, method : str="GET"):
+    latencies = []
+    peak_reset, start_rss = reset_peak_rss(), memory_status_mb("VmRSS")   # Peak of this endpoint only, not of startup & earlier endpoints
+    start_time = time.perf_counter()
+    for params in params_list:
+        request_start = time.perf_counter()
+        response = client.get(path, params=params) if method == "GET" else client.post(path, json=params)
+        latencies.append(time.perf_counter() - request_start)
+        assert response.status_code == 200, f"{path} returned {response.status_code}: {response.text[:200]}"
+    summary = summarize(latencies, time.perf_counter() - start_time)
+    summary["peak_rss_mb"] = memory_status_mb("VmHWM") if peak_reset else None
+    summary["rss_delta_mb"] = memory_status_mb("VmRSS") - start_rss if start_rss is not None else None
+    print(f"{path:<40} p50={summary['p50_ms']:.2f}ms p90={summary['p90_ms']:.2f}ms p99={summary['p99_ms']:.2f}ms "
+          f"{summary['throughput_rps']:.1f} req/s  peak={summary['peak_rss_mb'] or float('nan'):.1f} MB "
+          f"delta={summary['rss_delta_mb'] if summary['rss_delta_mb'] is not None else float('nan'):+.1f} MB")
+    return summary
+
+
+def check_shared_tables(results : dict):
+    """Write the API tables to a shared table store, memory-map them back & check every array & frame survived the round trip"""
+    import pandas as pd
+    import main
+    from data_sources import get_data_source
+    from table_store import TableStore
+
+    source = get_data_source()
+    tables = timed_stage(results, "api: fetch tables", main.fetch_tables, source, main.data_generation(source))
+    directory = os.path.join(tempfile.mkdtemp(prefix="table-store-"), "round-trip")
+    timed_stage(results, "api: write shared table store", tables.write, TableStore(directory))
+    attached = timed_stage(results, "api: attach shared table store", main.DataTables.read, TableStore(directory))
+
+    assert attached.version == tables.version, "Table store version changed"
+    for name in ("embeddings", "embedding_ids"):
+        assert np.array_equal(getattr(attached, name), getattr(tables, name)), f"Table store array {name} changed"
+    for name in ("user_ids", "offsets", "product_ids"):
+        assert np.array_equal(getattr(attached.order_index, name), getattr(tables.order_index, name)), f"Table store order index {name} changed"
+    assert attached.order_index.product_names == tables.order_index.product_names, "Table store order product names changed"
+    for name in ("df_neighbors", "df_products", "df_rfm", "df_users"):
+        pd.testing.assert_frame_equal(getattr(attached, name).copy(deep=True), getattr(tables, name),   # Deep copy, memory-mapped arrays are a different class
+                                      check_dtype=False, check_categorical=False, obj=f"Table store frame {name}")
+    print(f"{'api: shared table store round trip':<40} {'ok':>10}")
+
+
+def bench_api(args, results : dict):
+    """Start the API in-process & measure startup time & per-endpoint latency"""
+    import main
+    from fastapi.testclient import TestClient
+
+    rng = np.random.default_rng(args.seed)
+    with TestClient(main.app) as client:
+        start_time = time.perf_counter()
+        while client.get("/readyz").status_code != 200 or main.clv_store.get() is None:   # Wait for data & CLV model
+            assert main.startup_error is None, main.startup_error
+            assert time.perf_counter() - start_time < args.timeout, "API did not become ready in time"
+            time.sleep(0.1)
+        results["startup"] = {"seconds" : time.perf_counter() - start_time, "peak_rss_mb" : peak_rss_mb()}
+        print(f"{'startup':<40} {results['startup']['seconds']:>10.3f} s  {results['startup']['peak_rss_mb']:>10.1f} MB")
+
+        customer_ids = rng.choice(main.snapshot.order_index.user_ids, args.requests)
+        results["/recommend-products"] = bench_endpoint(client, "/recommend-products", [{"customer_id" : int(id)} for id in customer_ids])
+        batches = [{"customer_ids" : customer_ids[start:start + args.batch_size].tolist()} for start in range(0, len(customer_ids), args.batch_size)]
+        results["/recommend-products/batch"] = bench_endpoint(client, "/recommend-products/batch", batches, method="POST")
+        results["/upcoming-shoppers"] = bench_endpoint(client, "/upcoming-shoppers", [{}] * max(1, args.requests // 10))
+        clv_ids = rng.choice(main.clv_store.current.df_scores.index.values, args.requests)
+        results["/customer-clv"] = bench_endpoint(client, "/customer-clv", [{"customer_id" : int(id)} for id in clv_ids])
+        clv_batches = [{"customer_ids" : clv_ids[start:start + args.batch_size].tolist()} for start in range(0, len(clv_ids), args.batch_size)]
+        results["/customer-clv/batch"] = bench_endpoint(client, "/customer-clv/batch", clv_batches, method="POST")
+        results["api stages"] = json.loads(json.dumps(main.metrics.STAGE_SECONDS.report()))
+
+
+def bench_clv_stages(args, results : dict):
+    """Measure each stage of the CLV batch job in-process"""
+    import pandas as pd
+    from clv import RFM_COLUMNS, PredictorGGF, RfmStore, order_dates, rfm_summary, rfm_table
+    from data_sources import get_data_source
+
+    source = get_data_source()
+    df_rfm = rfm_table(timed_stage(results, "clv: query rfm summary (sql)", source.query, "RFM_SUMMARY", True))
+    rfm_store = timed_stage(results, "clv: build rfm aggregates (sql)", RfmStore.build, source, True)
+    store_diff = (rfm_store.summary()[RFM_COLUMNS] - df_rfm[RFM_COLUMNS]).abs().max().max()
+    results["clv: max absolute rfm difference (store vs sql)"] = float(store_diff)
+    print(f"{'clv: max absolute rfm store difference':<40} {store_diff:>10.2e}")
+    assert store_diff < RFM_TOLERANCE, f"RFM store differs from the RFM_SUMMARY query by {store_diff}"
+
+    # Reference summary computed in pandas from every order, to check the warehouse aggregation
+    df_order_values = timed_stage(results, "clv: query order values", source.query, "ORDER_VALUES", True)
+
+    # Aggregates of the oldest 80% of the orders updated with the rest, which must equal the full build
+    partial_store = RfmStore.build(source, True, until=df_order_values.created_at.quantile(0.8))
+    updated_store = timed_stage(results, "clv: update rfm aggregates (sql)", partial_store.update, source, True)
+    update_diff = (updated_store.summary()[RFM_COLUMNS] - rfm_store.summary()[RFM_COLUMNS]).abs().max().max()
+    results["clv: max absolute rfm difference (update vs build)"] = float(update_diff)
+    print(f"{'clv: max absolute rfm update difference':<40} {update_diff:>10.2e}")
+    assert update_diff < RFM_TOLERANCE and (updated_store.n_rows, updated_store.fingerprint) == (rfm_store.n_rows, rfm_store.fingerprint), \
+        f"Updated RFM store differs from a full build by {update_diff}"
+    df_order_values['created_at'] = order_dates(df_order_values.created_at)
+    df_reference = timed_stage(results, "clv: rfm summary (lifetimes)", rfm_summary, df_order_values)
+    sql_diff = (df_rfm[RFM_COLUMNS] - df_reference[RFM_COLUMNS].reindex(df_rfm.index)).abs().max().max()
+    results["clv: max absolute rfm difference (sql vs lifetimes)"] = float(sql_diff)
+    print(f"{'clv: max absolute rfm difference':<40} {sql_diff:>10.2e}")
+    model = PredictorGGF(df_rfm)
+    fitted_params = {}
+    for engine in ("lifetimes", "numpy"):
+        bgf_summary = timed_stage(results, f"clv: fit bgf ({engine})", model.fit_bgf, 0.01, engine)
+        ggf_summary = timed_stage(results, f"clv: fit ggf ({engine})", model.fit_ggf, 0.01, engine)
+        fitted_params[engine] = pd.concat([bgf_summary['coef'], ggf_summary['coef']])
+    timed_stage(results, "clv: fit bgf & ggf (numpy, warm start)", lambda : (model.fit_bgf(0.01, "numpy", model.bgf.params_.to_dict()),
+                                                                            model.fit_ggf(0.01, "numpy", model.ggf.params_.to_dict())))
+    relative_diff = ((fitted_params["numpy"] - fitted_params["lifetimes"]).abs() / fitted_params["lifetimes"].abs()).max()
+    results["clv: max relative parameter difference (numpy vs lifetimes)"] = float(relative_diff)
+    print(f"{'clv: max relative parameter difference':<40} {relative_diff:>10.2e}")
+    assert relative_diff < CLV_PARAM_TOLERANCE, f"Penalized numpy & lifetimes fits differ by {relative_diff:.2e} (tolerance {CLV_PARAM_TOLERANCE:.0e})"
+    timed_stage(results, "clv: predict clv", model.predict_clv, 24)
+
+
+def bench_batch_jobs(args, results : dict):
+    """Run each batch script as a subprocess & record its wall time & peak memory.
+
+    The peak is sampled from the child's own VmHWM while it runs: `ru_maxrss` of a child spawned by this process starts
+    from this process's high-water mark, so it would report the API's memory for a job smaller than the API.
+    """
+    for job in args.jobs:
+        start_time = time.perf_counter()
+        report_path = os.path.join(tempfile.mkdtemp(prefix="timings-"), f"{job}.json")
+        process = subprocess.Popen([sys.executable, os.path.join(BACKEND_DIR, f"{job}.py")], env=dict(os.environ, TIMING_REPORT=report_path),
+                                   stdout=subprocess.DEVNULL if not args.verbose else None)
+        peak_mb = 0.0
+        while process.poll() is None:   # VmHWM only grows, so the last sample before exit is the peak up to ~10 ms before exit
+            peak_mb = max(peak_mb, memory_status_mb("VmHWM", process.pid) or 0.0)
+            time.sleep(0.01)
+        assert process.returncode == 0, f"{job}.py failed"
+        results[f"job: {job}"] = {"seconds" : time.perf_counter() - start_time, "peak_rss_mb" : peak_mb}
+        if os.path.exists(report_path):   # Per-stage timings written by the job
+            with open(report_path) as f:
+                results[f"job: {job}"]["stages"] = json.load(f)["stage_duration_seconds"]
+        print(f"{'job: ' + job:<40} {results[f'job: {job}']['seconds']:>10.3f} s  {results[f'job: {job}']['peak_rss_mb']:>10.1f} MB")
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the API & batch jobs on a local dataset created by synthetic-data.py")
+    parser.add_argument("--data-dir", required=True, help="directory written by synthetic-data.py")
+    parser.add_argument("--requests", type=int, default=500, help="number of /recommend-products requests")
+    parser.add_argument("--batch-size", type=int, default=100, help="customer ids per /recommend-products/batch request")
+    parser.add_argument("--jobs", nargs="*", default=["upcoming-shoppers", "recs-spreadsheet"],
+                        help="batch scripts to run, in order (product-embeddings needs the embedding model)")
+    parser.add_argument("--skip-api", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--timeout", type=float, default=3600, help="seconds to wait for the API to become ready")
+    parser.add_argument("--output", default=None, help="write the results as JSON to this file")
+    parser.add_argument("--verbose", action="store_true", help="show the output of the batch scripts")
+    args = parser.parse_args()
+
+    # Point every component at the local dataset, with fresh caches so nothing is reused between runs
+    os.environ["DATA_BACKEND"] = "local"
+    os.environ["LOCAL_DATA_DIR"] = os.path.abspath(args.data_dir)
+    os.environ["ARTIFACT_DIR"] = tempfile.mkdtemp(prefix="artifacts-")
+    os.environ["CLV_CACHE_DIR"] = tempfile.mkdtemp(prefix="clv-cache-")
+    sys.path.insert(0, BACKEND_DIR)
+
+    results = {"data_dir" : os.path.abspath(args.data_dir)}
+    if not args.skip_api:
+        check_shared_tables(results)
+        bench_api(args, results)
+    bench_clv_stages(args, results)
+    bench_batch_jobs(args, results)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Saved benchmark results to {args.output}")
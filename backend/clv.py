@@ -0,0 +1,516 @@
+# Import packages to predict customer lifetime value
+import hashlib
+import json
+import os
+import threading
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import lifetimes
+
+import clv_fit
+import metrics
+from table_store import atomic_path, file_lock
+
+
+SCORE_HORIZONS = (6, 12, 24)   # Months of the expected purchases & predicted equity stored in the scoring table
+
+
+def bgf_from_params(bgf_params : dict, penalty_coef : float=0.01):
+    """Beta-Geometric/NBD model restored from fitted parameters"""
+    bgf = lifetimes.BetaGeoFitter(penalty_coef)
+    bgf.params_ = pd.Series(bgf_params)
+    bgf.predict = bgf.conditional_expected_number_of_purchases_up_to_time   # Set by `fit`, used by `customer_lifetime_value`
+    return bgf
+
+
+def ggf_from_params(ggf_params : dict, penalty_coef : float=0.01):
+    """Gamma-Gamma model restored from fitted parameters"""
+    ggf = lifetimes.GammaGammaFitter(penalty_coef)
+    ggf.params_ = pd.Series(ggf_params)
+    return ggf
+
+
+def clv_scores(bgf, ggf, df_summary, horizons : tuple=SCORE_HORIZONS, discount_rate : float=0.1):
+    """Score customers over several horizons in one pass over the months
+    Args:
+        bgf (BetaGeoFitter) – fitted Beta-Geometric/NBD model
+        ggf (GammaGammaFitter) – fitted Gamma-Gamma model
+        df_summary (DataFrame) – RFM summary of the customers, indexed by customer id
+        horizons (tuple, optional) – horizons in months. Default: SCORE_HORIZONS
+        discount_rate (float, optional) – the monthly adjusted discount rate. Default: 0.1
+
+    Returns:
+        DataFrame – probability alive 'prob_alive', & 'expected_purchases_<h>m' & 'pred_equity_<h>m' for every horizon h,
+        indexed like `df_summary`. 'pred_equity_<h>m' is the same as `PredictorGGF.predict_clv(time=h)`
+    """
+    frequency, recency, T = (df_summary[column].to_numpy(dtype=float) for column in ('frequency', 'recency', 'T'))
+    monetary_value = np.asarray(ggf.conditional_expected_average_profit(df_summary['frequency'], df_summary['monetary_value']), dtype=float)
+
+    # Discount the expected spend of each month like `GammaGammaFitter.customer_lifetime_value` with freq "D"
+    scores = {'prob_alive' : np.asarray(bgf.conditional_probability_alive(frequency, recency, T), dtype=float)}
+    clv, previous_purchases = np.zeros(len(df_summary)), 0
+    for month in range(1, max(horizons) + 1):
+        purchases = np.asarray(bgf.conditional_expected_number_of_purchases_up_to_time(month * 30, frequency, recency, T), dtype=float)
+        clv += monetary_value * (purchases - previous_purchases) / (1 + discount_rate) ** month
+        previous_purchases = purchases
+        if month in horizons:
+            scores[f'expected_purchases_{month}m'] = purchases
+            scores[f'pred_equity_{month}m'] = clv.copy()
+    return pd.DataFrame(scores, index=df_summary.index)
+
+
+# Create Gamma-Gamma Model based prediction model class
+class PredictorGGF:
+    def __init__(self, df_summary):
+        self.model_name = "GGF"
+        self.df_summary = df_summary
+        self.correlation = self.df_summary[self.df_summary.frequency != 0][['monetary_value', 'frequency']].corr().values[0,1]
+
+        return print(f"Correlation between shopper frequency & monetary value is : {float(self.correlation):.5f}.")
+
+    @metrics.measure("bgf_fit")
+    def fit_bgf(self, penalty_coef : float=0.01, engine : str="lifetimes", initial_params : dict=None):
+        """Fit the Beta-Geometric/NBD model
+        Args:
+            penalty_coef (float, optional) – penalizer coefficient. Default: 0.01
+            engine (str, optional) – {"lifetimes", "numpy"} the generic `lifetimes` fitter, or the vectorized fitter of `clv_fit`. Default: "lifetimes"
+            initial_params (dict, optional) – parameters of a previous fit to warm-start the "numpy" engine from. Default: None
+        """
+        if engine == "numpy":
+            params = clv_fit.fit_bgf(self.df_summary['frequency'], self.df_summary['recency'], self.df_summary['T'],
+                                     penalizer_coef=penalty_coef, initial_params=initial_params)
+            self._set_bgf_params(params, penalty_coef)
+            print(f"Beta-Gamma model successfully fitted")
+            return self.bgf.params_.to_frame('coef')
+
+        self.bgf = lifetimes.BetaGeoFitter(penalty_coef)
+        self.bgf.fit(self.df_summary['frequency'],
+                    self.df_summary['recency'],
+                    self.df_summary['T'])
+
+        print(f"Beta-Gamma model successfully fitted")
+        return self.bgf.summary
+
+    @metrics.measure("ggf_fit")
+    def fit_ggf(self, penalty_coef : float=0.01, engine : str="lifetimes", initial_params : dict=None):
+        """Fit the Gamma-Gamma model on returning shoppers, with the same `engine` & `initial_params` options as `fit_bgf`"""
+        assert self.correlation < 0.1, f"Correlation between frequency and monetary value for returning customers is {self.correlation} - this is quite high and may cause poor predictions"
+
+        returning = self.df_summary[self.df_summary.frequency != 0]
+        if engine == "numpy":
+            params = clv_fit.fit_ggf(returning['frequency'], returning['monetary_value'], penalizer_coef=penalty_coef, initial_params=initial_params)
+            self._set_ggf_params(params, penalty_coef)
+            summary = self.ggf.params_.to_frame('coef')
+        else:
+            self.ggf = lifetimes.GammaGammaFitter(penalty_coef)
+            self.ggf.fit(returning['frequency'],
+                         returning['monetary_value'])
+            summary = self.ggf.summary
+
+        print(f"Gamma-Gamma model successfully fitted")
+        if float(self.ggf.params_['q']) < 1:
+            print("Outliers in the data are causing the 'q' parameter for the Gamma-Gamma model to be < 1 therefore model predictions will fail.\nFix this by either removing outliers until you get 'q' > 1, or use raw monetary values to model CLV.")
+
+        return summary
+
+    def _set_bgf_params(self, bgf_params : dict, penalty_coef : float):
+        self.bgf = bgf_from_params(bgf_params, penalty_coef)
+
+    def _set_ggf_params(self, ggf_params : dict, penalty_coef : float):
+        self.ggf = ggf_from_params(ggf_params, penalty_coef)
+
+    def set_params(self, bgf_params : dict, ggf_params : dict, penalty_coef : float=0.01):
+        """Restore previously fitted Beta-Gamma & Gamma-Gamma models from their parameters instead of refitting them"""
+        self._set_bgf_params(bgf_params, penalty_coef)
+        self._set_ggf_params(ggf_params, penalty_coef)
+
+    @metrics.measure("clv_predict")
+    def predict_clv(self, time : int=12, discount_rate : float=0.1, freq : str="D"):
+        """Predict Customer Lifetime Value
+        Args:
+            time (float, optional) – the lifetime expected for the user in months. Default: 12
+            discount_rate (float, optional) – the monthly adjusted discount rate. Default: 0.01
+            freq (string, optional) – {“D”, “H”, “M”, “W”} for day, hour, month, week. This represents what unit of time your T is measure in.
+
+        Returns:
+            Series – Series object with customer ids as index and the estimated customer lifetime values as values
+        """
+
+        # Predict customer lifetime value
+        clv_preds_df = self.ggf.customer_lifetime_value(
+                            self.bgf,
+                            self.df_summary['frequency'],
+                            self.df_summary['recency'],
+                            self.df_summary['T'],
+                            self.df_summary['monetary_value'],
+                            time=time,
+                            discount_rate=discount_rate,
+                            freq=freq
+                        ).to_frame()
+
+        return clv_preds_df
+
+    @metrics.measure("clv_score")
+    def score(self, horizons : tuple=SCORE_HORIZONS, discount_rate : float=0.1):
+        """Probability alive, expected purchases & predicted equity of every shopper over several horizons, see `clv_scores`"""
+        return clv_scores(self.bgf, self.ggf, self.df_summary, horizons=horizons, discount_rate=discount_rate)
+
+
+def rfm_summary(df_order_values):
+    """Create the RFM summary (frequency, recency, T, monetary value & revenue) of every user from their order values"""
+    df_rfm  = lifetimes.utils.summary_data_from_transaction_data(df_order_values, 'user_id', 'created_at',
+                                                                 freq='D', include_first_transaction = False)
+    df_rfm = pd.merge(df_rfm, df_order_values.groupby('user_id')['order_value'].agg(['mean', 'sum']),
+                      how='left', on='user_id').rename(columns={'mean' : 'monetary_value', 'sum' : 'revenue'})
+    return df_rfm
+
+
+def order_dates(created_at):
+    """Purchase day of every order as a timezone-naive datetime, vectorized instead of converting row by row"""
+    timestamps = pd.to_datetime(pd.Series(created_at))
+    return (timestamps.dt.tz_localize(None) if timestamps.dt.tz is not None else timestamps).dt.normalize()
+
+
+RFM_COLUMNS = ['frequency', 'recency', 'T', 'monetary_value', 'revenue']
+
+
+def rfm_table(df_rfm):
+    """RFM summary computed by the "RFM_SUMMARY" query, as float columns indexed & ordered by user id like `rfm_summary`"""
+    return df_rfm.set_index('user_id').sort_index()[RFM_COLUMNS].astype(float)
+
+
+class RfmStore:
+    """Per-user RFM aggregates of the orders up to a `created_at` watermark.
+
+    Each user keeps their first & last purchase day, the number of distinct purchase days, the number of orders and
+    their revenue. The warehouse aggregates the orders created since the watermark ("RFM_AGGREGATES" query) & `update`
+    folds them in without scanning the rest of the history, and `summary` turns the aggregates into the same
+    frequency/recency/T/monetary value table as `rfm_summary`.
+    """
+    COLUMNS = ['first_date', 'last_date', 'n_days', 'n_orders', 'revenue']
+    EXTENSIONS = (".parquet",)
+    METADATA_KEY = b"rfm_store"
+
+    def __init__(self, df_aggregates, watermark=None, n_rows : int=0, fingerprint : int=0):
+        """
+        Args:
+            df_aggregates (DataFrame) – `COLUMNS` of every user, indexed by user id
+            watermark (Timestamp, optional) – latest `created_at` folded into the aggregates. Default: None
+            n_rows (int, optional) – number of orders folded into the aggregates. Default: 0
+            fingerprint (int, optional) – XOR of the hashes of the orders folded into the aggregates, see "ORDER_FINGERPRINT". Default: 0
+        """
+        self.df_aggregates = df_aggregates
+        self.watermark = watermark
+        self.n_rows = n_rows
+        self.fingerprint = fingerprint
+
+    @staticmethod
+    def _fingerprint(hashes):
+        """XOR of 64-bit order hashes, signed (BigQuery) or unsigned (DuckDB), as an unsigned int"""
+        return int(np.bitwise_xor.reduce(np.asarray(hashes).astype(np.uint64)))
+
+    @staticmethod
+    def _query(source, exclude_cancelled : bool, after=None, until=None):
+        """Aggregates of the orders created after `after` computed by the warehouse, with their watermark, number of orders & fingerprint"""
+        df = source.query("RFM_AGGREGATES", exclude_cancelled=exclude_cancelled, after=after, until=until)
+        df_aggregates = df.set_index('user_id').sort_index()[RfmStore.COLUMNS]
+        df_aggregates = df_aggregates.astype({'first_date' : 'datetime64[ns]', 'last_date' : 'datetime64[ns]', 'n_days' : 'int64',
+                                              'n_orders' : 'int64', 'revenue' : 'float64'})
+        watermark = pd.Timestamp(df.watermark.max()) if len(df) > 0 else None
+        return df_aggregates, watermark, int(df.n_rows.sum()), RfmStore._fingerprint(df.fingerprint.values)
+
+    @classmethod
+    @metrics.measure("rfm_build")
+    def build(cls, source, exclude_cancelled : bool=False, until=None):
+        """Aggregate the full order history, or the orders created up to `until`"""
+        return cls(*cls._query(source, exclude_cancelled, until=until))
+
+    @metrics.measure("rfm_update")
+    def update(self, source, exclude_cancelled : bool=False):
+        """Fold the orders created since the watermark into the aggregates
+        Args:
+            source (DataSource) – data source the aggregates were built from
+            exclude_cancelled (bool, optional) – drop cancelled orders, as when the aggregates were built. Default: False
+
+        Returns:
+            RfmStore – updated aggregates. Falls back to a full `build` if orders up to the watermark were added, edited
+            or removed, or their items changed, since the aggregates can only be extended with orders after the watermark
+        """
+        if self.watermark is None:
+            return RfmStore.build(source, exclude_cancelled)
+
+        df_history = source.query("ORDER_FINGERPRINT", exclude_cancelled=exclude_cancelled, until=self.watermark)
+        if (int(df_history.n_rows.iloc[0]), self._fingerprint(df_history.fingerprint.values)) != (self.n_rows, self.fingerprint):
+            print(f"Order history up to {self.watermark} changed - recomputing RFM aggregates from scratch")
+            return RfmStore.build(source, exclude_cancelled)
+        new_aggregates, watermark, n_new, fingerprint = self._query(source, exclude_cancelled, after=self.watermark)
+        if n_new == 0:
+            return self
+
+        old = self.df_aggregates.reindex(new_aggregates.index)
+        returning = old.first_date.notna()
+
+        # New days all fall on or after each returning user's last day, so only a purchase on that same day is counted twice
+        merged = new_aggregates.copy()
+        merged.loc[returning, 'first_date'] = old.first_date[returning]
+        merged.loc[returning, 'n_days'] = (old.n_days + new_aggregates.n_days - (new_aggregates.first_date == old.last_date))[returning]
+        merged.loc[returning, 'n_orders'] = (old.n_orders + new_aggregates.n_orders)[returning]
+        merged.loc[returning, 'revenue'] = (old.revenue + new_aggregates.revenue)[returning]
+
+        df_aggregates = pd.concat([self.df_aggregates.drop(index=merged.index[returning]), merged]).sort_index()
+        df_aggregates = df_aggregates.astype({'n_days' : 'int64', 'n_orders' : 'int64', 'revenue' : 'float64'})
+        print(f"Folded {n_new} new orders of {len(new_aggregates)} users into the RFM aggregates")
+        return RfmStore(df_aggregates, max(self.watermark, watermark), self.n_rows + n_new, self.fingerprint ^ fingerprint)
+
+    @metrics.measure("rfm_summary")
+    def summary(self):
+        """RFM summary (frequency, recency, T, monetary value & revenue) of every user, identical to `rfm_summary`"""
+        df = self.df_aggregates
+        observation_end = df.last_date.max()   # Same default observation period end as `summary_data_from_transaction_data`
+        df_rfm = pd.DataFrame({'frequency' : (df.n_days - 1).astype(float),
+                               'recency' : (df.last_date - df.first_date).dt.days.astype(float),
+                               'T' : (observation_end - df.first_date).dt.days.astype(float),
+                               'monetary_value' : df.revenue / df.n_orders,
+                               'revenue' : df.revenue.astype(float)}, index=df.index)
+        return df_rfm.rename_axis('user_id')
+
+    def save(self, path : str):
+        """Save the aggregates as one `.parquet` table whose metadata holds the watermark, so the two are always replaced together
+        Args:
+            path (str) – file path without extension, e.g. '/tmp/rfm_aggregates'
+
+        Returns:
+            list – paths of the written files
+        """
+        table = pa.Table.from_pandas(self.df_aggregates)
+        state = {"watermark" : self.watermark.isoformat() if self.watermark is not None else None, "n_rows" : self.n_rows,
+                 "fingerprint" : self.fingerprint}
+        table = table.replace_schema_metadata({**table.schema.metadata, self.METADATA_KEY : json.dumps(state).encode("utf-8")})
+        with atomic_path(path + ".parquet") as tmp_path:
+            pq.write_table(table, tmp_path)
+        return [path + ext for ext in self.EXTENSIONS]
+
+    @classmethod
+    def load(cls, path : str):
+        """Load aggregates written by `save`"""
+        table = pq.read_table(path + ".parquet")
+        state = json.loads(table.schema.metadata[cls.METADATA_KEY])
+        watermark = pd.Timestamp(state["watermark"]) if state["watermark"] is not None else None
+        return cls(table.to_pandas()[cls.COLUMNS], watermark, state["n_rows"], state.get("fingerprint", 0))
+
+
+@metrics.measure("shopper_table")
+def shopper_table(df_all, df_users, min_pred_equity : float=0, max_T : int=90):
+    """Rank upcoming shoppers & join their user details
+    Args:
+        df_all (DataFrame) – RFM summary & predicted equity of every shopper, indexed by user id
+        df_users (DataFrame) – users table
+        min_pred_equity (float, optional) – only include shoppers predicted to spend more than this. Default: 0
+        max_T (int, optional) – only include shoppers whose first purchase was less than `max_T` days ago. Default: 90
+
+    Returns:
+        DataFrame – one row per upcoming shopper ordered by predicted equity, with the columns of the `Shopper` response
+        & the days since their first purchase `T`
+    """
+    # Select shoppers whose first purchase was recent and whose predicted equity is high enough
+    upcoming = df_all.loc[(df_all.pred_equity > min_pred_equity) & (df_all['T'] < max_T), ['pred_equity', 'T']].sort_values(by='pred_equity', ascending=False)
+
+    # Join user details on the user id index in one pass, keeping the predicted equity ranking
+    df_shoppers = upcoming.join(df_users.set_index('id')[['first_name', 'last_name', 'email', 'age', 'gender', 'country']], how='inner')
+    return pd.DataFrame({'shopper_id' : df_shoppers.index.values,
+                         'name' : (df_shoppers.first_name.astype(str) + ' ' + df_shoppers.last_name.astype(str)).values,   # Names may be categorical
+                         'email' : df_shoppers.email.astype(str).values,
+                         'age' : df_shoppers.age.values,
+                         'gender' : df_shoppers.gender.values,
+                         'country' : df_shoppers.country.values,
+                         'pred_equity' : df_shoppers.pred_equity.round(2).values,
+                         'T' : df_shoppers['T'].values})
+
+
+def data_version(df_rfm):
+    """Fingerprint of the RFM summary used to fit the CLV model, so cached models are only reused for identical data"""
+    row_hashes = pd.util.hash_pandas_object(df_rfm[RFM_COLUMNS], index=True)
+    return hashlib.sha1(row_hashes.values.tobytes()).hexdigest()[:16]
+
+
+SNAPSHOT_FORMAT = 4   # Bump when the persisted snapshot layout changes
+
+
+class ClvSnapshot:
+    def __init__(self, version : str, bgf_params : dict, ggf_params : dict, df_scores, df_shoppers, horizons : tuple=SCORE_HORIZONS,
+                 fitted_at : str=None):
+        """Fitted CLV model parameters, scoring table & ranked shoppers for one version of the order data
+        Args:
+            version (str) – data version the model was fitted to, see `data_version`
+            bgf_params (dict) – fitted Beta-Geometric/NBD parameters
+            ggf_params (dict) – fitted Gamma-Gamma parameters
+            df_scores (DataFrame) – RFM summary & `clv_scores` of every shopper over `horizons`, indexed by user id
+            df_shoppers (DataFrame) – every shopper ranked by predicted equity, see `shopper_table`
+            horizons (tuple, optional) – horizons in months of the scoring table. Default: SCORE_HORIZONS
+            fitted_at (str, optional) – ISO timestamp of the fit. Default: now
+        """
+        self.version = version
+        self.bgf_params = bgf_params
+        self.ggf_params = ggf_params
+        self.df_scores = df_scores
+        self.df_shoppers = df_shoppers
+        self.horizons = tuple(horizons)
+        self.fitted_at = fitted_at or datetime.now(timezone.utc).isoformat()
+        self._rows = {}
+        self._rows_lock = threading.Lock()
+        self._models = None
+
+    @property
+    def state(self):
+        """Persisted fields of the snapshot, without the in-memory filter cache"""
+        return {name : value for name, value in vars(self).items() if not name.startswith('_')}
+
+    def ranked_rows(self, min_pred_equity : float, max_T : float, country : str=None):
+        """Positions in `df_shoppers` of the shoppers matching the filters, in predicted equity order
+        Args:
+            min_pred_equity (float) – only shoppers predicted to spend more than this
+            max_T (float) – only shoppers whose first purchase was less than `max_T` days ago
+            country (str, optional) – only shoppers from this country. Default: None
+
+        Returns:
+            array – row positions, cached per filter combination so paging through the results filters only once
+        """
+        key = (min_pred_equity, max_T, country)
+        rows = self._rows.get(key)
+        if rows is None:
+            mask = (self.df_shoppers.pred_equity.values > min_pred_equity) & (self.df_shoppers['T'].values < max_T)
+            if country is not None:
+                mask &= self.df_shoppers.country.values == country
+            rows = np.flatnonzero(mask)
+            with self._rows_lock:
+                if len(self._rows) >= 64:
+                    self._rows.pop(next(iter(self._rows)))   # Drop the oldest filter combination
+                self._rows[key] = rows
+        return rows
+
+    @property
+    def score_columns(self):
+        return ['prob_alive'] + [f'{name}_{months}m' for months in self.horizons for name in ('expected_purchases', 'pred_equity')]
+
+    def scores(self, customer_ids : list, df_rfm=None):
+        """Scores of customers looked up in the scoring table, scoring the customers missing from it on demand
+        Args:
+            customer_ids (list) – unique customer ids
+            df_rfm (DataFrame, optional) – current RFM summary indexed by user id, used to score the customers whose first
+                order came after the fit. Default: None
+
+        Returns:
+            DataFrame – `score_columns` & whether they were 'precomputed' of the customers found in the scoring table or
+            `df_rfm`, indexed by customer id. Ids found in neither are left out
+        """
+        customer_ids = pd.Index(customer_ids)
+        positions = self.df_scores.index.get_indexer(customer_ids)   # Hash lookup, the hash table is built once per snapshot
+        df = self.df_scores.iloc[positions[positions >= 0]][self.score_columns].assign(precomputed=True)
+
+        missing = customer_ids[positions < 0]
+        if len(missing) > 0 and df_rfm is not None:
+            df_missing = df_rfm.loc[df_rfm.index.intersection(missing)]
+            if len(df_missing) > 0:
+                if self._models is None:
+                    self._models = (bgf_from_params(self.bgf_params), ggf_from_params(self.ggf_params))
+                with metrics.timer("clv_score_on_demand"):
+                    df_missing = clv_scores(*self._models, df_missing, horizons=self.horizons).assign(precomputed=False)
+                df = pd.concat([df, df_missing])
+        return df
+
+
+class ClvModelStore:
+    def __init__(self, cache_dir : str, penalty_coef : float=0.01, time : int=24, max_T : int=90, min_pred_equity : float=0,
+                 fit_engine : str="numpy"):
+        """Serve CLV predictions from memory, refit them in the background & persist them by data version
+        Args:
+            cache_dir (str) – directory where fitted snapshots are persisted
+            penalty_coef (float, optional) – penalizer coefficient of both models. Default: 0.01
+            time (int, optional) – prediction horizon in months. Default: 24
+            max_T (int, optional) – default filter: only shoppers whose first purchase was less than `max_T` days ago are upcoming shoppers. Default: 90
+            min_pred_equity (float, optional) – default filter: only shoppers predicted to spend more than this are upcoming shoppers. Default: 0
+            fit_engine (str, optional) – {"numpy", "lifetimes"} fitting engine, see `PredictorGGF.fit_bgf`. Default: "numpy"
+        """
+        self.cache_dir = cache_dir
+        self.penalty_coef = penalty_coef
+        self.time = time
+        self.max_T = max_T
+        self.min_pred_equity = min_pred_equity
+        self.fit_engine = fit_engine
+        self.current = None
+        self.rfm_store = None
+        self._rfm_lock = threading.Lock()
+        self._refit_lock = threading.Lock()
+        self._refit_thread = None
+
+    def _path(self, version : str):
+        return os.path.join(self.cache_dir, f"clv_v{SNAPSHOT_FORMAT}_{version}.pkl")
+
+    def rfm_summary(self, source):
+        """Fold the orders added since the last call into the persisted RFM aggregates & summarize them, see `RfmStore`"""
+        path = os.path.join(self.cache_dir, "rfm_aggregates")
+        with self._rfm_lock, file_lock(path):   # One API worker process at a time, each continuing from the latest saved aggregates
+            if all(os.path.exists(path + ext) for ext in RfmStore.EXTENSIONS):
+                self.rfm_store = RfmStore.load(path)
+            self.rfm_store = self.rfm_store.update(source) if self.rfm_store is not None else RfmStore.build(source)
+            os.makedirs(self.cache_dir, exist_ok=True)
+            self.rfm_store.save(path)
+            return self.rfm_store.summary()
+
+    def load(self, version : str):
+        """Load a persisted snapshot for `version` if one exists. Returns True if it was loaded"""
+        if not os.path.exists(self._path(version)):
+            return False
+        snapshot = ClvSnapshot(**pd.read_pickle(self._path(version)))
+        self.current = snapshot   # Single reference assignment, so requests see either the old or the new snapshot
+        print(f"Loaded CLV model for data version {version} fitted at {snapshot.fitted_at}")
+        return True
+
+    def refit(self, df_rfm, df_users, version : str):
+        """Fit the CLV model to the RFM summary (see `rfm_table`), score every shopper, persist the snapshot & swap it in"""
+        with self._refit_lock, file_lock(self._path(version)):   # Only one refit at a time, across API worker processes too
+            if self.current is not None and self.current.version == version:
+                return self.current
+            if self.load(version):   # Fitted by another worker while this one waited for the lock
+                return self.current
+
+            start_time = datetime.now()
+
+            # Fit prediction model to RFM data, warm-started from the parameters of the previous snapshot
+            model = PredictorGGF(df_rfm)
+            previous = self.current
+            model.fit_bgf(penalty_coef=self.penalty_coef, engine=self.fit_engine, initial_params=previous.bgf_params if previous else None)
+            model.fit_ggf(penalty_coef=self.penalty_coef, engine=self.fit_engine, initial_params=previous.ggf_params if previous else None)
+
+            # Score every shopper over each horizon, including the ranking horizon, & rank upcoming shoppers
+            horizons = tuple(sorted(set(SCORE_HORIZONS) | {self.time}))
+            df_scores = df_rfm.join(model.score(horizons=horizons))
+            df_all = df_rfm.assign(pred_equity=df_scores[f'pred_equity_{self.time}m'])
+            df_shoppers = shopper_table(df_all, df_users, min_pred_equity=-np.inf, max_T=np.inf)   # Every shopper, filtered per request with `ranked_rows`
+
+            snapshot = ClvSnapshot(version, model.bgf.params_.to_dict(), model.ggf.params_.to_dict(), df_scores, df_shoppers, horizons)
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with atomic_path(self._path(version)) as tmp_path:   # Atomic write, a crashed refit never leaves a partial file
+                pd.to_pickle(snapshot.state, tmp_path)
+
+            self.current = snapshot
+            print(f"Finished fitting CLV model for data version {version} - Time Taken = {datetime.now() - start_time}")
+            return snapshot
+
+    def refit_async(self, df_rfm, df_users, version : str):
+        """Start `refit` in a background thread unless one is already running"""
+        if self._refit_thread is not None and self._refit_thread.is_alive():
+            return self._refit_thread
+        self._refit_thread = threading.Thread(target=self.refit, args=(df_rfm, df_users, version), daemon=True)
+        self._refit_thread.start()
+        return self._refit_thread
+
+    def get(self, timeout : float=None):
+        """Return the current snapshot, waiting for a running refit if none has been loaded yet"""
+        if self.current is None and self._refit_thread is not None:
+            self._refit_thread.join(timeout)
+        return self.current
@@ -0,0 +1,120 @@
+# Vectorized maximum likelihood fitting of the BG/NBD & Gamma-Gamma models
+# Same objectives as `lifetimes.BetaGeoFitter` & `lifetimes.GammaGammaFitter`, evaluated with NumPy on the unique rows
+# of the data with analytic gradients, so the fitted parameters match `lifetimes` within the optimizer tolerance
+import numpy as np
+from lifetimes.utils import _scale_time
+from scipy.optimize import minimize
+from scipy.special import digamma, gammaln
+
+BGF_PARAMS = ("r", "alpha", "a", "b")
+GGF_PARAMS = ("p", "q", "v")
+
+
+def compress(*columns):
+    """Unique rows of `columns` and how many times each occurs"""
+    unique_rows, counts = np.unique(np.column_stack([np.asarray(column, dtype=np.float64) for column in columns]), axis=0, return_counts=True)
+    return [unique_rows[:, i] for i in range(len(columns))], counts.astype(np.float64)
+
+
+def bgf_negative_log_likelihood(log_params, frequency, recency, T, weights, penalizer_coef : float):
+    """Penalized mean negative log-likelihood of the BG/NBD model & its gradient w.r.t. the log parameters"""
+    params = np.exp(log_params)
+    r, alpha, a, b = params
+    x, t = frequency, recency
+    has_repeat = x > 0
+
+    A_1 = gammaln(r + x) - gammaln(r) + r * np.log(alpha)
+    A_2 = gammaln(a + b) + gammaln(b + x) - gammaln(b) - gammaln(a + b + x)
+    A_3 = -(r + x) * np.log(alpha + T)
+    A_4 = np.log(a) - np.log(b + np.where(has_repeat, x, 1) - 1) - (r + x) * np.log(t + alpha)
+
+    # log(exp(A_3) + exp(A_4)) for repeat customers, A_3 otherwise, and the share of each term
+    max_A = np.where(has_repeat, np.maximum(A_3, A_4), A_3)
+    exp_3 = np.exp(A_3 - max_A)
+    exp_4 = np.where(has_repeat, np.exp(A_4 - max_A), 0)
+    log_sum = np.log(exp_3 + exp_4) + max_A
+    share_3 = exp_3 / (exp_3 + exp_4)
+    share_4 = 1 - share_3
+
+    ll = A_1 + A_2 + log_sum
+    d_r = digamma(r + x) - digamma(r) + np.log(alpha) - share_3 * np.log(alpha + T) - share_4 * np.log(t + alpha)
+    d_alpha = r / alpha - share_3 * (r + x) / (alpha + T) - share_4 * (r + x) / (t + alpha)
+    d_a = digamma(a + b) - digamma(a + b + x) + share_4 / a
+    d_b = digamma(a + b) + digamma(b + x) - digamma(b) - digamma(a + b + x) - share_4 / (b + np.where(has_repeat, x, 1) - 1)
+
+    total_weight = weights.sum()
+    value = -(ll * weights).sum() / total_weight + penalizer_coef * (params ** 2).sum()
+    grad = np.array([-(d * weights).sum() / total_weight for d in (d_r, d_alpha, d_a, d_b)]) + 2 * penalizer_coef * params
+    return value, grad * params   # Chain rule for the log parameters
+
+
+def ggf_negative_log_likelihood(log_params, frequency, monetary_value, weights, penalizer_coef : float):
+    """Penalized mean negative log-likelihood of the Gamma-Gamma model & its gradient w.r.t. the log parameters"""
+    params = np.exp(log_params)
+    p, q, v = params
+    x, m = frequency, monetary_value
+
+    ll = (gammaln(p * x + q) - gammaln(p * x) - gammaln(q) + q * np.log(v)
+          + (p * x - 1) * np.log(m) + (p * x) * np.log(x) - (p * x + q) * np.log(x * m + v))
+    d_p = x * (digamma(p * x + q) - digamma(p * x) + np.log(m) + np.log(x) - np.log(x * m + v))
+    d_q = digamma(p * x + q) - digamma(q) + np.log(v) - np.log(x * m + v)
+    d_v = q / v - (p * x + q) / (x * m + v)
+
+    total_weight = weights.sum()
+    value = -(ll * weights).sum() / total_weight + penalizer_coef * (params ** 2).sum()
+    grad = np.array([-(d * weights).sum() / total_weight for d in (d_p, d_q, d_v)]) + 2 * penalizer_coef * params
+    return value, grad * params
+
+
+def _minimize(negative_log_likelihood, initial_log_params, args, tol : float):
+    result = minimize(negative_log_likelihood, initial_log_params, args=args, jac=True, method="BFGS", tol=tol)
+    if not np.isfinite(result.fun):
+        raise ValueError(f"Fitting did not converge: {result.message}")
+    if not result.success:
+        print(f"Warning: {result.message} (negative log-likelihood = {result.fun:.6f})")   # Usually precision loss at the optimum
+    return result
+
+
+def fit_bgf(frequency, recency, T, penalizer_coef : float=0.0, initial_params : dict=None, tol : float=1e-7):
+    """Fit the BG/NBD model
+    Args:
+        frequency, recency, T (array) – RFM summary columns, as passed to `lifetimes.BetaGeoFitter.fit`
+        penalizer_coef (float, optional) – L2 penalty on the parameters, like `lifetimes`. Default: 0.0
+        initial_params (dict, optional) – parameters of a previous fit to warm-start from. Default: None
+        tol (float, optional) – optimizer tolerance. Default: 1e-7
+
+    Returns:
+        dict – fitted parameters {"r", "alpha", "a", "b"}
+    """
+    (x, t, T), weights = compress(frequency, recency, T)
+    scale = _scale_time(T)   # The time rescaling of `lifetimes` itself, the penalty applies to the scaled alpha
+    if initial_params is None:
+        initial_log_params = 0.1 * np.ones(len(BGF_PARAMS))   # `lifetimes` default starting point, in log space
+    else:
+        initial_log_params = np.log([initial_params["r"], initial_params["alpha"] * scale, initial_params["a"], initial_params["b"]])
+
+    result = _minimize(bgf_negative_log_likelihood, initial_log_params, (x, t * scale, T * scale, weights, penalizer_coef), tol)
+    params = dict(zip(BGF_PARAMS, np.exp(result.x).tolist()))
+    params["alpha"] /= scale
+    return params
+
+
+def fit_ggf(frequency, monetary_value, penalizer_coef : float=0.0, initial_params : dict=None, tol : float=1e-7):
+    """Fit the Gamma-Gamma model on returning customers
+    Args:
+        frequency, monetary_value (array) – RFM summary columns of customers with frequency > 0
+        penalizer_coef (float, optional) – L2 penalty on the parameters, like `lifetimes`. Default: 0.0
+        initial_params (dict, optional) – parameters of a previous fit to warm-start from. Default: None
+        tol (float, optional) – optimizer tolerance. Default: 1e-7
+
+    Returns:
+        dict – fitted parameters {"p", "q", "v"}
+    """
+    (x, m), weights = compress(frequency, monetary_value)
+    if initial_params is None:
+        initial_log_params = 0.1 * np.ones(len(GGF_PARAMS))
+    else:
+        initial_log_params = np.log([initial_params[name] for name in GGF_PARAMS])
+
+    result = _minimize(ggf_negative_log_likelihood, initial_log_params, (x, m, weights, penalizer_coef), tol)
+    return dict(zip(GGF_PARAMS, np.exp(result.x).tolist()))
@@ -0,0 +1,353 @@
+# Import packages to access the ecommerce data
+import os
+import shutil
+
+import pandas as pd
+
+
+#### Named queries shared by the API & the batch jobs
+# Table names & dialect-specific expressions are filled in by each data source, e.g. `project.dataset.products` for BigQuery.
+# Each query selects only the columns its consumers use & leaves the row order to them.
+QUERIES = {
+"PRODUCTS" : """
+SELECT
+  id,
+  name
+FROM {products};
+""",
+
+"ORDERS" : """
+SELECT
+  order_items.user_id,
+  order_items.product_id,
+  products.name AS product_name
+FROM {order_items} AS order_items
+    LEFT JOIN {products} AS products ON order_items.product_id = products.id
+WHERE order_items.status != 'Cancelled';
+""",
+
+"ORDER_VALUES" : """
+WITH order_values AS (
+    SELECT
+      order_id,
+      SUM(sale_price) AS order_value
+    FROM {order_items}
+    GROUP BY order_id
+)
+SELECT
+  orders.order_id,
+  orders.user_id,
+  orders.created_at,
+  order_values.order_value
+FROM {orders} AS orders
+    LEFT JOIN order_values ON orders.order_id = order_values.order_id
+{where};
+""",
+
+# Same frequency, recency, T & monetary value as `clv.rfm_summary` over the "ORDER_VALUES" rows, one row per user
+"RFM_SUMMARY" : """
+WITH order_values AS (
+    SELECT
+      order_id,
+      SUM(sale_price) AS order_value
+    FROM {order_items}
+    GROUP BY order_id
+),
+user_orders AS (
+    SELECT
+      orders.user_id,
+      MIN(CAST(orders.created_at AS DATE)) AS first_date,
+      MAX(CAST(orders.created_at AS DATE)) AS last_date,
+      COUNT(DISTINCT CAST(orders.created_at AS DATE)) AS n_days,
+      COUNT(order_values.order_value) AS n_orders,
+      COALESCE(SUM(order_values.order_value), 0) AS revenue
+    FROM {orders} AS orders
+        LEFT JOIN order_values ON orders.order_id = order_values.order_id
+    {where}
+    GROUP BY orders.user_id
+),
+observation AS (
+    SELECT MAX(last_date) AS observation_end
+    FROM user_orders
+)
+SELECT
+  user_orders.user_id,
+  user_orders.n_days - 1 AS frequency,
+  {recency_days} AS recency,
+  {T_days} AS T,
+  user_orders.revenue / NULLIF(user_orders.n_orders, 0) AS monetary_value,
+  user_orders.revenue
+FROM user_orders
+    CROSS JOIN observation;
+""",
+
+# Per-user RFM aggregates folded into `clv.RfmStore`, with the number of orders, the XOR of their hashes & the latest `created_at` of each user
+"RFM_AGGREGATES" : """
+WITH selected_orders AS (
+    SELECT
+      orders.order_id,
+      orders.user_id,
+      orders.status,
+      orders.created_at
+    FROM {orders} AS orders
+    {where}
+),
+order_values AS (
+    SELECT
+      order_items.order_id,
+      SUM(order_items.sale_price) AS order_value
+    FROM {order_items} AS order_items
+        INNER JOIN selected_orders ON order_items.order_id = selected_orders.order_id
+    GROUP BY order_items.order_id
+)
+SELECT
+  selected_orders.user_id,
+  MIN(CAST(selected_orders.created_at AS DATE)) AS first_date,
+  MAX(CAST(selected_orders.created_at AS DATE)) AS last_date,
+  COUNT(DISTINCT CAST(selected_orders.created_at AS DATE)) AS n_days,
+  COUNT(order_values.order_value) AS n_orders,
+  COALESCE(SUM(order_values.order_value), 0) AS revenue,
+  COUNT(*) AS n_rows,
+  BIT_XOR({order_hash}) AS fingerprint,
+  MAX(selected_orders.created_at) AS watermark
+FROM selected_orders
+    LEFT JOIN order_values ON selected_orders.order_id = order_values.order_id
+GROUP BY selected_orders.user_id;
+""",
+
+# Number of orders & XOR of their hashes, which changes when any order is added, removed or edited, or its items are
+"ORDER_FINGERPRINT" : """
+WITH selected_orders AS (
+    SELECT
+      orders.order_id,
+      orders.user_id,
+      orders.status,
+      orders.created_at
+    FROM {orders} AS orders
+    {where}
+),
+order_values AS (
+    SELECT
+      order_items.order_id,
+      SUM(order_items.sale_price) AS order_value
+    FROM {order_items} AS order_items
+        INNER JOIN selected_orders ON order_items.order_id = selected_orders.order_id
+    GROUP BY order_items.order_id
+)
+SELECT
+  COUNT(*) AS n_rows,
+  COALESCE(BIT_XOR({order_hash}), 0) AS fingerprint
+FROM selected_orders
+    LEFT JOIN order_values ON selected_orders.order_id = order_values.order_id;
+""",
+
+"USERS" : """
+SELECT
+  id,
+  first_name,
+  last_name,
+  email,
+  age,
+  gender,
+  country
+FROM {users};
+""",
+}
+TABLES = ("products", "orders", "order_items", "users")
+ORDER_HASH_COLUMNS = ("selected_orders.order_id", "selected_orders.user_id", "selected_orders.status", "selected_orders.created_at",
+                      "ROUND(order_values.order_value, 6)")   # Rounded, floating point sums may differ in the last bits between runs
+
+
+def _utc_text(value):
+    """Timestamp as UTC text with microseconds, timezone-naive timestamps are taken as UTC"""
+    value = pd.Timestamp(value)
+    return (value.tz_convert("UTC") if value.tz is not None else value).strftime("%Y-%m-%d %H:%M:%S.%f")
+
+
+class DataSource:
+    """Runs the named queries & reads/writes files ("blobs") for one storage backend"""
+    name = None
+
+    def table(self, table : str):
+        raise NotImplementedError
+
+    def date_diff(self, start : str, end : str):
+        """SQL expression of the number of days between two DATE expressions"""
+        raise NotImplementedError
+
+    def timestamp(self, value):
+        """SQL literal of a (UTC) timestamp"""
+        raise NotImplementedError
+
+    def hash(self, text : str):
+        """SQL expression of a 64-bit integer hash of a STRING expression"""
+        raise NotImplementedError
+
+    def run_query(self, sql : str):
+        """Run a query and return the result as an Arrow table"""
+        raise NotImplementedError
+
+    def query(self, name : str, exclude_cancelled : bool=False, after=None, until=None):
+        """Run one of the named QUERIES and return the result as a DataFrame
+        Args:
+            name (str) – {"PRODUCTS", "ORDERS", "ORDER_VALUES", "RFM_SUMMARY", "RFM_AGGREGATES", "ORDER_FINGERPRINT", "USERS"} name of the query
+            exclude_cancelled (bool, optional) – drop cancelled orders from the order level queries. Default: False
+            after (Timestamp, optional) – only orders created after this time, in the order level queries. Default: None
+            until (Timestamp, optional) – only orders created up to this time, in the order level queries. Default: None
+        """
+        conditions = (["orders.status != 'Cancelled'"] if exclude_cancelled else []) + \
+                     ([f"orders.created_at > {self.timestamp(after)}"] if after is not None else []) + \
+                     ([f"orders.created_at <= {self.timestamp(until)}"] if until is not None else [])
+        where = "WHERE " + " AND ".join(conditions) if conditions else ""
+        sql = QUERIES[name].format(where=where, recency_days=self.date_diff("user_orders.first_date", "user_orders.last_date"),
+                                   T_days=self.date_diff("user_orders.first_date", "observation.observation_end"),
+                                   order_hash=self.hash(", '|', ".join(f"COALESCE(CAST({column} AS STRING), '')" for column in ORDER_HASH_COLUMNS)),
+                                   **{table : self.table(table) for table in TABLES})
+        return self.run_query(sql).to_pandas(date_as_object=False)   # DATE columns as datetime64 instead of Python objects
+
+    def exists(self, blob_name : str):
+        raise NotImplementedError
+
+    def generation(self, blob_name : str):
+        """Value that changes whenever the blob is rewritten, or None if it does not exist"""
+        raise NotImplementedError
+
+    def table_generation(self, table : str):
+        """Value that changes whenever the table is modified"""
+        raise NotImplementedError
+
+    def download_bytes(self, blob_name : str):
+        raise NotImplementedError
+
+    def download_file(self, blob_name : str, path : str):
+        raise NotImplementedError
+
+    def upload_file(self, blob_name : str, path : str, content_type : str):
+        raise NotImplementedError
+
+    def upload_bytes(self, blob_name : str, buffer, content_type : str):
+        raise NotImplementedError
+
+
+class BigQuerySource(DataSource):
+    name = "bigquery"
+
+    def __init__(self, project : str="ecommerce-data-project-444616", dataset : str="the_look_ecommerce_constant",
+                 bucket : str="bucket-quickstart_ecommerce-data-project-444616"):
+        """Query the BigQuery dataset & store files in the Google Cloud Storage bucket"""
+        from google.cloud import storage, bigquery
+        self.project = project
+        self.dataset = dataset
+        self.bigquery_client = bigquery.Client()
+        self.bucket = storage.Client().bucket(bucket)
+
+    def table(self, table : str):
+        return f"`{self.project}.{self.dataset}.{table}`"
+
+    def date_diff(self, start : str, end : str):
+        return f"DATE_DIFF({end}, {start}, DAY)"
+
+    def timestamp(self, value):
+        return f"TIMESTAMP '{_utc_text(value)}+00'"
+
+    def hash(self, text : str):
+        return f"FARM_FINGERPRINT(CONCAT({text}))"
+
+    def run_query(self, sql : str):
+        return self.bigquery_client.query_and_wait(sql).to_arrow()   # Read with the BigQuery Storage API when it is installed
+
+    def exists(self, blob_name : str):
+        return self.bucket.blob(blob_name).exists()
+
+    def generation(self, blob_name : str):
+        blob = self.bucket.get_blob(blob_name)   # Metadata request only, the object generation changes on every upload
+        return None if blob is None else blob.generation
+
+    def table_generation(self, table : str):
+        return self.bigquery_client.get_table(f"{self.project}.{self.dataset}.{table}").modified.isoformat()
+
+    def download_bytes(self, blob_name : str):
+        return self.bucket.blob(blob_name).download_as_bytes()
+
+    def download_file(self, blob_name : str, path : str):
+        self.bucket.blob(blob_name).download_to_filename(path)
+
+    def upload_file(self, blob_name : str, path : str, content_type : str):
+        self.bucket.blob(blob_name).upload_from_filename(path, content_type=content_type, timeout=600)
+
+    def upload_bytes(self, blob_name : str, buffer, content_type : str):
+        self.bucket.blob(blob_name).upload_from_file(buffer, content_type=content_type, timeout=600)
+
+
+class LocalSource(DataSource):
+    name = "local"
+
+    def __init__(self, data_dir : str, blob_dir : str=None):
+        """Query Parquet files with DuckDB & store files in a local directory
+        Args:
+            data_dir (str) – directory containing `products.parquet`, `orders.parquet`, `order_items.parquet` & `users.parquet`
+            blob_dir (str, optional) – directory used in place of the storage bucket. Default: `<data_dir>/bucket`
+        """
+        import duckdb
+        self.duckdb = duckdb
+        self.data_dir = data_dir
+        self.blob_dir = blob_dir or os.path.join(data_dir, "bucket")
+        os.makedirs(self.blob_dir, exist_ok=True)
+
+    def table(self, table : str):
+        return f"read_parquet('{os.path.join(self.data_dir, table + '.parquet')}')"
+
+    def date_diff(self, start : str, end : str):
+        return f"date_diff('day', {start}, {end})"
+
+    def timestamp(self, value):
+        return f"TIMESTAMPTZ '{_utc_text(value)}+00'"
+
+    def hash(self, text : str):
+        return f"hash(concat({text}))"
+
+    def run_query(self, sql : str):
+        with self.duckdb.connect() as con:   # One in-memory connection per query, so queries can run in parallel threads
+            con.execute("SET TimeZone = 'UTC'")   # Truncate timestamps to UTC days like BigQuery
+            result = con.execute(sql)
+            return result.to_arrow_table() if hasattr(result, "to_arrow_table") else result.fetch_arrow_table()   # Renamed in DuckDB 1.5
+
+    def _blob_path(self, blob_name : str):
+        return os.path.join(self.blob_dir, blob_name)
+
+    def exists(self, blob_name : str):
+        return os.path.exists(self._blob_path(blob_name))
+
+    def generation(self, blob_name : str):
+        return os.stat(self._blob_path(blob_name)).st_mtime_ns if self.exists(blob_name) else None
+
+    def table_generation(self, table : str):
+        return os.stat(os.path.join(self.data_dir, table + ".parquet")).st_mtime_ns
+
+    def download_bytes(self, blob_name : str):
+        with open(self._blob_path(blob_name), "rb") as f:
+            return f.read()
+
+    def download_file(self, blob_name : str, path : str):
+        if os.path.abspath(self._blob_path(blob_name)) != os.path.abspath(path):
+            shutil.copyfile(self._blob_path(blob_name), path)
+
+    def upload_file(self, blob_name : str, path : str, content_type : str):
+        if os.path.abspath(self._blob_path(blob_name)) != os.path.abspath(path):
+            shutil.copyfile(path, self._blob_path(blob_name) + ".tmp")
+            os.replace(self._blob_path(blob_name) + ".tmp", self._blob_path(blob_name))
+
+    def upload_bytes(self, blob_name : str, buffer, content_type : str):
+        with open(self._blob_path(blob_name) + ".tmp", "wb") as f:
+            shutil.copyfileobj(buffer, f)
+        os.replace(self._blob_path(blob_name) + ".tmp", self._blob_path(blob_name))
+
+
+def get_data_source():
+    """Create the data source selected by the DATA_BACKEND environment variable ("bigquery" or "local")"""
+    backend = os.getenv("DATA_BACKEND", "bigquery")
+    if backend == "bigquery":
+        return BigQuerySource()
+    if backend == "local":
+        return LocalSource(os.getenv("LOCAL_DATA_DIR", "data"), os.getenv("LOCAL_BLOB_DIR"))
+    raise ValueError(f"Unknown DATA_BACKEND '{backend}' - expected 'bigquery' or 'local'")
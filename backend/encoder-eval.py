@@ -0,0 +1,120 @@
+# Compare encoder runtimes & models against the fp32 PyTorch baseline: load time, encoding speed & top-5 recommendation overlap
+# Usage: python backend/encoder-eval.py --candidates all-mpnet-base-v2:onnx all-mpnet-base-v2:onnx-int8 all-MiniLM-L6-v2:torch
+#        Exits with status 1 if a candidate's overlap is below --min-overlap, so it can gate a switch of ENCODER_BACKEND
+import argparse
+import json
+import sys
+import time
+
+import numpy as np
+
+from data_sources import get_data_source
+from encoders import DEFAULT_MODEL, create_encoder, parse_encoder
+from recommender import EmbeddingIndex, OrderIndex, SimilarityEngine, recommend_batch
+
+
+def evaluate_encoder(spec : str, names : list, args):
+    """Load an encoder, embed the whole catalog & time single-name queries like the API encodes them"""
+    start_time = time.perf_counter()
+    encoder = create_encoder(*parse_encoder(spec))
+    load_seconds = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    embeddings = encoder.encode(names, batch_size=args.batch_size)
+    encode_seconds = time.perf_counter() - start_time
+
+    query_names = np.random.default_rng(args.seed).choice(names, size=min(args.queries, len(names)), replace=False).tolist()
+    latencies = []
+    for name in query_names:
+        query_start = time.perf_counter()
+        encoder.encode(name)
+        latencies.append(time.perf_counter() - query_start)
+
+    stats = {"encoder" : encoder.name,
+             "dimension" : encoder.dimension,
+             "load_seconds" : load_seconds,
+             "catalog_encode_seconds" : encode_seconds,
+             "catalog_products_per_second" : len(names) / encode_seconds,
+             "query_p50_ms" : float(np.percentile(latencies, 50) * 1000),
+             "query_p99_ms" : float(np.percentile(latencies, 99) * 1000)}
+    return encoder, embeddings, stats
+
+
+def recommendation_overlap(baseline_recs : dict, candidate_recs : dict):
+    """Mean fraction of the baseline's recommended products also recommended by the candidate
+    Returns:
+        tuple – (overlap of the top-k of every purchased product, overlap of every customer's full set of recommended products)
+    """
+    product_overlaps, customer_overlaps = [], []
+    for customer_id, rec_dict in baseline_recs.items():
+        for name, ids in rec_dict.items():
+            product_overlaps.append(len(set(ids) & set(candidate_recs[customer_id][name])) / len(ids))
+        baseline_ids = {id for ids in rec_dict.values() for id in ids}
+        candidate_ids = {id for ids in candidate_recs[customer_id].values() for id in ids}
+        if baseline_ids:
+            customer_overlaps.append(len(baseline_ids & candidate_ids) / len(baseline_ids))
+    return float(np.mean(product_overlaps)), float(np.mean(customer_overlaps))
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description="Compare encoder backends & models by top-k recommendation overlap with a baseline encoder")
+    parser.add_argument("--baseline", default=f"{DEFAULT_MODEL}:torch", help="reference encoder as model[:backend]")
+    parser.add_argument("--candidates", nargs="+", default=[f"{DEFAULT_MODEL}:onnx", f"{DEFAULT_MODEL}:onnx-int8", "all-MiniLM-L6-v2:torch"],
+                        help="encoders to compare as model[:backend], backend one of torch, onnx, onnx-int8")
+    parser.add_argument("--customers", type=int, default=2000, help="number of sampled customers whose recommendations are compared")
+    parser.add_argument("--queries", type=int, default=200, help="number of single-name encodings timed per encoder")
+    parser.add_argument("--batch-size", type=int, default=64, help="batch size used to encode the catalog")
+    parser.add_argument("-k", type=int, default=5, help="recommended products per purchased product")
+    parser.add_argument("--min-overlap", type=float, default=0.9, help="minimum top-k overlap with the baseline for a candidate to pass")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    # Catalog & the purchases of a sample of customers, from the source selected by DATA_BACKEND
+    source = get_data_source()
+    df_products = source.query("PRODUCTS")
+    order_index = OrderIndex(source.query("ORDERS"))
+    product_ids, names = df_products.id.values, df_products.name.astype(str).tolist()
+    rng = np.random.default_rng(args.seed)
+    customer_ids = rng.choice(order_index.user_ids, size=min(args.customers, len(order_index)), replace=False).tolist()
+    purchases = {customer_id : order_index.purchases(customer_id) for customer_id in customer_ids}
+    print(f"Comparing encoders on {len(names)} products & {len(purchases)} customers")
+
+    baseline, baseline_embeddings, baseline_stats = evaluate_encoder(args.baseline, names, args)
+    baseline_engine = SimilarityEngine(baseline_embeddings, product_ids)
+    baseline_recs = recommend_batch(purchases, baseline_engine, EmbeddingIndex(baseline_embeddings, product_ids, baseline.encode), k=args.k)
+    results = {"products" : len(names), "customers" : len(purchases), "k" : args.k, "baseline" : baseline_stats, "candidates" : []}
+    del baseline   # Only one candidate model in memory at a time
+
+    failed = []
+    for spec in args.candidates:
+        encoder, embeddings, stats = evaluate_encoder(spec, names, args)
+
+        # Catalog & queries both embedded by the candidate, i.e. after re-running product-embeddings.py with it
+        engine = SimilarityEngine(embeddings, product_ids)
+        candidate_recs = recommend_batch(purchases, engine, EmbeddingIndex(embeddings, product_ids, encoder.encode), k=args.k)
+        stats["top_k_overlap"], stats["customer_overlap"] = recommendation_overlap(baseline_recs, candidate_recs)
+
+        # Candidate queries searched in the baseline catalog, i.e. switching ENCODER_BACKEND without rebuilding the artifact
+        if encoder.model_name == parse_encoder(args.baseline)[0] and embeddings.shape[1] == baseline_embeddings.shape[1]:
+            query_recs = recommend_batch(purchases, baseline_engine, EmbeddingIndex(embeddings, product_ids, encoder.encode), k=args.k)
+            stats["query_top_k_overlap"], _ = recommendation_overlap(baseline_recs, query_recs)
+            stats["max_abs_embedding_diff"] = float(np.abs(embeddings - baseline_embeddings).max())
+
+        stats["passed"] = stats["top_k_overlap"] >= args.min_overlap
+        if not stats["passed"]:
+            failed.append(encoder.name)
+        results["candidates"].append(stats)
+        print(f"{encoder.name:<40} top-{args.k} overlap={stats['top_k_overlap']:.4f} customer overlap={stats['customer_overlap']:.4f} "
+              f"load={stats['load_seconds']:.1f}s catalog={stats['catalog_products_per_second']:.0f} products/s "
+              f"query p50={stats['query_p50_ms']:.2f}ms ({stats['query_p50_ms'] / baseline_stats['query_p50_ms']:.2f}x baseline) "
+              f"{'PASS' if stats['passed'] else 'FAIL'}")
+        del encoder, embeddings
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Saved encoder evaluation to {args.output}")
+    if failed:
+        print(f"Top-{args.k} overlap below {args.min_overlap} for {', '.join(failed)}")
+        sys.exit(1)
@@ -0,0 +1,114 @@
+# Import packages to embed product names with interchangeable encoder runtimes
+import fcntl
+import os
+from contextlib import contextmanager
+
+import numpy as np
+
+DEFAULT_MODEL = "all-mpnet-base-v2"
+BACKENDS = ("torch", "onnx", "onnx-int8")
+
+
+class Encoder:
+    """Sentence embedding model that embeds product names, whatever runtime executes it.
+
+    Every backend returns float32 embeddings of the same model, so product embeddings created with one backend can
+    be searched with query embeddings of another - `encoder-eval.py` measures how much that changes recommendations.
+    """
+    backend = None
+
+    def __init__(self, model_name : str=DEFAULT_MODEL):
+        self.model_name = model_name
+        self.model = self._load()
+
+    def _load(self):
+        raise NotImplementedError
+
+    @property
+    def name(self):
+        return f"{self.model_name}:{self.backend}"
+
+    @property
+    def dimension(self):
+        return self.model.get_sentence_embedding_dimension()
+
+    def encode(self, sentences, batch_size : int=32):
+        """Embed one name (1-D array) or a list of names (2-D array with one row per name)"""
+        return np.asarray(self.model.encode(sentences, batch_size=batch_size, convert_to_numpy=True), dtype=np.float32)
+
+
+class TorchEncoder(Encoder):
+    """The model in fp32 PyTorch, the reference runtime"""
+    backend = "torch"
+
+    def _load(self):
+        from sentence_transformers import SentenceTransformer
+        return SentenceTransformer(self.model_name, device="cpu")
+
+
+class OnnxEncoder(Encoder):
+    """The model exported to ONNX Runtime, optionally with int8 dynamically quantized weights.
+
+    The exported (& quantized) model is cached in `cache_dir`, so it is only created once per machine or image.
+    Requires `pip install "sentence-transformers[onnx]"`.
+    """
+    def __init__(self, model_name : str=DEFAULT_MODEL, quantize : bool=False, quantization : str="avx2", cache_dir : str="/tmp/encoders"):
+        """
+        Args:
+            model_name (str, optional) – sentence-transformers model name or path. Default: "all-mpnet-base-v2"
+            quantize (bool, optional) – use int8 weights instead of fp32. Default: False
+            quantization (str, optional) – {"arm64", "avx2", "avx512", "avx512_vnni"} quantization config matching the CPU. Default: "avx2"
+            cache_dir (str, optional) – directory of the exported models. Default: "/tmp/encoders"
+        """
+        self.backend = "onnx-int8" if quantize else "onnx"
+        self.quantization = quantization
+        self.path = os.path.join(cache_dir, model_name.replace("/", "__"))
+        super().__init__(model_name)
+
+    @contextmanager
+    def _lock(self):
+        """Exclusive lock so concurrent processes don't export the same model"""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path + ".lock", "w") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _load(self):
+        from sentence_transformers import SentenceTransformer, export_dynamic_quantized_onnx_model
+        file_name = f"onnx/model_qint8_{self.quantization}.onnx" if self.backend == "onnx-int8" else "onnx/model.onnx"
+        with self._lock():
+            if not os.path.exists(os.path.join(self.path, file_name)):
+                model = SentenceTransformer(self.model_name, backend="onnx", device="cpu")   # Exports the fp32 ONNX graph if the model has none
+                model.save_pretrained(self.path)
+                if self.backend == "onnx-int8":
+                    export_dynamic_quantized_onnx_model(model, self.quantization, self.path)
+        return SentenceTransformer(self.path, backend="onnx", device="cpu", model_kwargs={"file_name" : file_name})
+
+
+def create_encoder(model_name : str=DEFAULT_MODEL, backend : str="torch"):
+    """Create the encoder of `model_name` running on `backend`, one of `BACKENDS`"""
+    if backend == "torch":
+        return TorchEncoder(model_name)
+    if backend in ("onnx", "onnx-int8"):
+        return OnnxEncoder(model_name, quantize=backend == "onnx-int8", quantization=os.getenv("ENCODER_QUANTIZATION", "avx2"),
+                           cache_dir=os.getenv("ENCODER_CACHE_DIR", "/tmp/encoders"))
+    raise ValueError(f"Unknown encoder backend '{backend}' - expected one of {', '.join(BACKENDS)}")
+
+
+def parse_encoder(spec : str):
+    """Split an encoder spec 'model[:backend]', e.g. 'all-MiniLM-L6-v2:onnx-int8', into (model name, backend)"""
+    model_name, _, backend = spec.partition(":")
+    return model_name or DEFAULT_MODEL, backend or "torch"
+
+
+def embedding_model():
+    """Name of the embedding model selected by the EMBEDDING_MODEL environment variable, which also names the artifacts"""
+    return os.getenv("EMBEDDING_MODEL", DEFAULT_MODEL)
+
+
+def get_encoder():
+    """Create the encoder selected by the EMBEDDING_MODEL & ENCODER_BACKEND ("torch", "onnx" or "onnx-int8") environment variables"""
+    return create_encoder(embedding_model(), os.getenv("ENCODER_BACKEND", "torch"))
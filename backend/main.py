@@ -1,19 +1,33 @@
 import uvicorn
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
 from pydantic import BaseModel
-from typing import List
-
+from typing import List, Optional
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import threading
+import time
+import traceback
+
+import numpy as np
 import pandas as pd
 
-from sentence_transformers import SentenceTransformer
-from sklearn.metrics import DistanceMetric
-
-import lifetimes
-
-from google.cloud import storage, bigquery
+import base64
+import hashlib
 import io
+import json
 import os
+import shutil
+
+from artifacts import download_embedding_artifact
+from encoders import embedding_model, get_encoder
+from data_sources import TABLES, get_data_source
+import metrics
+from table_store import TableStore, compact_frame, prune_stores
+from clv import RFM_COLUMNS, ClvModelStore, data_version
+from recommender import EmbeddingIndex, OrderIndex, ResultCache, SimilarityEngine, neighbor_lookup, product_lookups, recommend_batch, recommended_names
 
 # Read environment variable
 environment = os.getenv("STAGING_OR_PROD")
@@ -25,7 +39,235 @@ else:
     FRONTEND_URL = "https://web-app-frontend-50293729231.europe-west10.run.app"
 
 
-app = FastAPI()
+########### ---------- DATA SOURCES ------------ #########
+MODEL_NAME = embedding_model()   # EMBEDDING_MODEL, the artifacts are created with the same model
+ARTIFACT_DIR = os.getenv("ARTIFACT_DIR", "/tmp/artifacts")
+
+
+def timed(name : str, func, *args):
+    """Run `func(*args)` and log how long it took"""
+    start_time = datetime.now()
+    print(f"Started {name} ...")
+    result = func(*args)
+    metrics.record(name, datetime.now() - start_time)
+    print(f"Finished {name} - Time Taken = {datetime.now() - start_time}")
+    return result
+
+
+def download_neighbor_table(source):
+    content = source.download_bytes(f"product_neighbors_{MODEL_NAME}.csv")
+    return pd.read_csv(io.BytesIO(content))
+
+
+# Columns each table is trimmed to, everything else is dropped when the tables are compacted
+PRODUCT_COLUMNS = ['id', 'name']
+RFM_TABLE_COLUMNS = ['user_id'] + RFM_COLUMNS
+USER_COLUMNS = ['id', 'first_name', 'last_name', 'email', 'age', 'gender', 'country']
+NEIGHBOR_COLUMNS = ['product_id', 'rank', 'neighbor_id']
+
+
+def recommendation_version(embedding_created_at : str, order_index):
+    """Fingerprint of the embeddings & purchases that recommendations are computed from"""
+    digest = hashlib.sha1(embedding_created_at.encode("utf-8"))
+    for array in (order_index.user_ids, order_index.offsets, order_index.product_ids):
+        digest.update(np.ascontiguousarray(array).tobytes())
+    return digest.hexdigest()[:16]
+
+
+class DataTables:
+    def __init__(self, embeddings, embedding_ids, df_neighbors, df_products, order_index, df_rfm, df_users, version : str):
+        """Compact tables the data snapshot is built from: int32 ids, categorical or shared buffer strings, float32 embeddings & only the used columns"""
+        self.version = version   # Recommendation data version, see `recommendation_version`
+        self.embeddings = embeddings
+        self.embedding_ids = embedding_ids
+        self.df_neighbors = df_neighbors
+        self.df_products = df_products
+        self.order_index = order_index
+        self.df_rfm = df_rfm   # RFM summary of every user, see `RfmStore.summary`
+        self.df_users = df_users
+
+    def write(self, store):
+        """Write the tables to a `TableStore`"""
+        store.put_array("embeddings", self.embeddings)
+        store.put_array("embedding_ids", self.embedding_ids)
+        store.put_array("order_user_ids", self.order_index.user_ids)
+        store.put_array("order_offsets", self.order_index.offsets)
+        store.put_array("order_product_ids", self.order_index.product_ids)
+        store.put_frame("order_products", compact_frame(pd.DataFrame({'product_id' : list(self.order_index.product_names.keys()),
+                                                                      'product_name' : list(self.order_index.product_names.values())}),
+                                                        ['product_id', 'product_name']))
+        for name, df in [("neighbors", self.df_neighbors), ("products", self.df_products), ("rfm", self.df_rfm), ("users", self.df_users)]:
+            store.put_frame(name, df)
+        store.put_metadata(version=self.version)
+        store.commit()
+
+    @classmethod
+    def read(cls, store):
+        """Attach to the memory-mapped tables of a complete `TableStore`"""
+        store.attach()
+        order_products = store.frame("order_products")
+        order_index = OrderIndex.from_arrays(store.array("order_user_ids"), store.array("order_offsets"), store.array("order_product_ids"),
+                                             dict(zip(order_products.product_id.tolist(), order_products.product_name.tolist())))
+        return cls(store.array("embeddings"), store.array("embedding_ids"), store.frame("neighbors"), store.frame("products"),
+                   order_index, store.frame("rfm"), store.frame("users"), store.metadata["version"])
+
+
+def data_generation(source):
+    """Fingerprint of the generation of every artifact & table the snapshot is built from, cheap to check repeatedly"""
+    blobs = [f"product_embeddings_{MODEL_NAME}.npy", f"product_embeddings_{MODEL_NAME}.json", f"product_neighbors_{MODEL_NAME}.csv"]
+    parts = [str(source.generation(blob)) for blob in blobs] + [str(source.table_generation(table)) for table in TABLES]
+    return hashlib.sha1("|".join(parts).encode("utf-8")).hexdigest()[:16]
+
+
+def fetch_tables(source, generation : str):
+    """Fetch every independent data source concurrently & compact the tables"""
+    artifact_dir = os.path.join(ARTIFACT_DIR, generation)   # One directory per generation, the previous snapshot may still map its files
+    with ThreadPoolExecutor(max_workers=6) as pool:
+        embedding_artifact = pool.submit(timed, "downloading product embeddings artifact", download_embedding_artifact, source, artifact_dir, MODEL_NAME)
+        df_neighbors = pool.submit(timed, "downloading product neighbors table", download_neighbor_table, source)
+        df_products = pool.submit(timed, f"querying {source.name} for products dataframe", source.query, "PRODUCTS")
+        df_orders = pool.submit(timed, f"querying {source.name} for orders dataframe", source.query, "ORDERS")
+        df_rfm = pool.submit(timed, f"querying {source.name} for new RFM aggregates", clv_store.rfm_summary, source)   # Only orders since the last fetch
+        df_users = pool.submit(timed, f"querying {source.name} for users dataframe", source.query, "USERS")
+
+        embedding_artifact = embedding_artifact.result()
+        order_index = timed("indexing orders", OrderIndex, df_orders.result())   # Customer id -> non-cancelled purchased product ids
+
+        return DataTables(np.ascontiguousarray(embedding_artifact.embeddings, dtype=np.float32), embedding_artifact.product_ids,
+                          compact_frame(df_neighbors.result(), NEIGHBOR_COLUMNS), compact_frame(df_products.result(), PRODUCT_COLUMNS),
+                          order_index, compact_frame(df_rfm.result().reset_index(), RFM_TABLE_COLUMNS), compact_frame(df_users.result(), USER_COLUMNS),
+                          recommendation_version(embedding_artifact.created_at, order_index))
+
+
+def load_shared_tables(source, store_dir : str, generation : str):
+    """Fetch & write the tables once per server & data generation, then memory-map them read-only in every uvicorn worker"""
+    key = f"{os.getenv('SHARED_STORE_KEY') or f'server-{os.getppid()}'}-{generation}"   # Workers of one server share their parent process
+    store = TableStore(os.path.join(store_dir, key))
+    with store.lock():   # The first worker writes the store while the others wait
+        if not store.complete:
+            timed("writing shared table store", fetch_tables(source, generation).write, store)
+            prune_stores(store_dir, keep=key)
+    return timed("attaching shared table store", DataTables.read, store)
+
+
+class DataSnapshot:
+    def __init__(self, model, tables, generation : str):
+        """Everything the endpoints read, built once from the loaded data tables"""
+        self.generation = generation   # See `data_generation`
+        self.version = tables.version
+        self.model = model
+        self.embedding_index = EmbeddingIndex(tables.embeddings, tables.embedding_ids, model.encode,   # Product id -> stored embedding, with an LRU cache for names outside the catalog
+                                              cache_size=int(os.getenv("ENCODE_CACHE_SIZE", 4096)))
+        self.similarity_engine = SimilarityEngine(tables.embeddings, tables.embedding_ids)   # Contiguous float32 embedding matrix for batched similarity search
+        self.product_neighbors = neighbor_lookup(tables.df_neighbors)   # Dictionary of product id -> top 5 most similar product ids
+        self.df_products = tables.df_products
+        self.product_names, self.product_positions = product_lookups(tables.df_products)   # Product id -> name & products table row
+        self.order_index = tables.order_index
+        self.df_rfm = tables.df_rfm.set_index('user_id')
+        self.df_users = tables.df_users
+
+
+def load_snapshot(source, generation : str, model=None):
+    """Load the embedding model (unless reused from the current snapshot) while the data tables are fetched or attached,
+    & build the data snapshot
+    """
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        if model is None:
+            model = pool.submit(timed, "loading LLM for product recommendations", get_encoder)   # Runtime selected by ENCODER_BACKEND
+        store_dir = os.getenv("SHARED_STORE_DIR")   # e.g. /dev/shm/ecommerce-api to share the tables between uvicorn workers
+        tables = load_shared_tables(source, store_dir, generation) if store_dir else fetch_tables(source, generation)
+        model = model.result() if hasattr(model, "result") else model
+        return timed("building data snapshot", DataSnapshot, model, tables, generation)
+
+
+# Shared state, populated in the background once the app is listening
+snapshot = None
+startup_error = None
+clv_store = ClvModelStore(os.getenv("CLV_CACHE_DIR", "/tmp/clv-cache"), penalty_coef=0.01, time=24, max_T=90, min_pred_equity=0,
+                          fit_engine=os.getenv("CLV_FIT_ENGINE", "numpy"))
+
+
+RELOAD_INTERVAL = float(os.getenv("RELOAD_INTERVAL", 0))   # Seconds between checks for new data, 0 disables hot reload
+
+
+def start_clv(data, background : bool=True):
+    """Fit the CLV model for the snapshot's order data, or reuse the model persisted for this version of the data"""
+    clv_version = data_version(data.df_rfm)
+    if not clv_store.load(clv_version):
+        print(f"Fitting CLV model for data version {clv_version}{' in the background' if background else ''}...")
+        if background:
+            clv_store.refit_async(data.df_rfm, data.df_users, clv_version)
+        else:
+            clv_store.refit(data.df_rfm, data.df_users, clv_version)   # Waits for a refit that is already running
+
+    # Optionally precompute the recommendations of the upcoming shoppers, who are the most likely to be looked up
+    warmup_size = int(os.getenv("RECS_CACHE_WARMUP", 0))
+    if warmup_size > 0:
+        threading.Thread(target=warm_recommendations_cache, args=(data, min(warmup_size, recs_cache.max_size)), daemon=True).start()
+
+
+def startup():
+    global snapshot, startup_error
+    try:
+        start_time = datetime.now()
+        source = get_data_source()   # BigQuery & Cloud Storage, or local Parquet files & directory (DATA_BACKEND)
+        snapshot = load_snapshot(source, data_generation(source))
+        print(f"API is ready - Total Startup Time = {datetime.now() - start_time}")
+        start_clv(snapshot)
+    except Exception:
+        startup_error = traceback.format_exc()
+        print(f"Startup failed:\n{startup_error}")
+        return
+
+    if RELOAD_INTERVAL > 0:
+        refresh_loop()
+
+
+def reload_if_changed(source):
+    """Build a new snapshot off the request path if any artifact or table changed, then swap it in. Returns True if it was swapped"""
+    global snapshot
+    generation = data_generation(source)
+    if generation == snapshot.generation:
+        return False
+
+    start_time = datetime.now()
+    print(f"Data generation changed from {snapshot.generation} to {generation} - reloading data in the background...")
+    new_snapshot = load_snapshot(source, generation, model=snapshot.model)
+    snapshot = new_snapshot   # Single reference assignment, in-flight requests keep the snapshot they started with
+    recs_cache.clear()   # Entries of the old version can no longer be hit, free them
+    for name in os.listdir(ARTIFACT_DIR):   # Files stay readable by the old snapshot until it is garbage collected
+        if name != generation and os.path.isdir(os.path.join(ARTIFACT_DIR, name)):
+            shutil.rmtree(os.path.join(ARTIFACT_DIR, name), ignore_errors=True)
+    print(f"Swapped in data generation {generation} - Time Taken = {datetime.now() - start_time}")
+    start_clv(new_snapshot, background=False)   # The current CLV model keeps serving until the new one is swapped in
+    return True
+
+
+def refresh_loop():
+    """Check for new data every RELOAD_INTERVAL seconds for the lifetime of the process"""
+    source = get_data_source()
+    while True:
+        time.sleep(RELOAD_INTERVAL)
+        try:
+            reload_if_changed(source)
+        except Exception:
+            print(f"Reloading data failed, keeping data generation {snapshot.generation}:\n{traceback.format_exc()}")
+
+
+@asynccontextmanager
+async def lifespan(app : FastAPI):
+    # Load data in a background thread so the server binds its port immediately, the same thread then checks for new data
+    threading.Thread(target=startup, daemon=True).start()
+    yield
+
+
+def get_snapshot():
+    if snapshot is None:
+        raise HTTPException(status_code=503, detail="Data is still loading")
+    return snapshot
+
+
+app = FastAPI(lifespan=lifespan)
 print(f"STAGING_OR_PROD={environment}, FRONTEND_URL={FRONTEND_URL}")
 
 origins = [
@@ -42,51 +284,38 @@ app.add_middleware(
 )
 
 
-####### ----------- RECOMMENDED PRODUCTS API FUNCTION ------------ ############
+@app.middleware("http")
+async def record_request_time(request : Request, call_next):
+    start_time = time.perf_counter()
+    status = 500   # Unhandled exceptions propagate past the middleware & are served as 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        route = request.scope.get("route")   # Path template, e.g. /recommend-products, so labels stay bounded
+        metrics.REQUEST_SECONDS.observe(time.perf_counter() - start_time, path=route.path if route else "unmatched", status=status)
+
+
+########### ---------- HEALTH CHECKS ------------ #########
+@app.get("/healthz")
+def healthz():
+    return {"status" : "ok"}
+
+@app.get("/readyz")
+def readyz():
+    if snapshot is None:
+        status = "failed" if startup_error is not None else "loading"
+        return JSONResponse(status_code=503, content={"status" : status})
+    return {"status" : "ready", "clv_model_ready" : clv_store.current is not None, "data_generation" : snapshot.generation, "encoder" : snapshot.model.name}
 
-# Load embedding model
-print(f"Loading LLM for product recommendations ...")
-model = SentenceTransformer("all-mpnet-base-v2")
-print(f"Loading metric for product recommendations ...")
-metric = DistanceMetric.get_metric('euclidean')
-
-# Get product embeddings dataframe
-print(f"Downloading product embeddings dataframe ...")
-client = storage.Client() # Connect to Google Cloud Storage
-blob = client.bucket("bucket-quickstart_ecommerce-data-project-444616").blob("product_embeddings_all-mpnet-base-v2.csv") # Connect to google cloud bucket
-content = blob.download_as_bytes() # Download the embeddings file
-df_embedding = pd.read_csv(io.BytesIO(content)) # Convert to Pandas DataFrame
-
-# Get products dataframe
-print(f"Querying BigQuery for products dataframe")
-client = bigquery.Client()
-PRODUCTS_QUERY  = f"""
-SELECT *
-FROM `ecommerce-data-project-444616.the_look_ecommerce_constant.products`;
-"""
-df_products = client.query_and_wait(PRODUCTS_QUERY).to_dataframe()
-
-# Get orders dataframe
-print(f"Querying BigQuery for orders dataframe")
-ORDERS_QUERY  = f"""
-SELECT
-order_items.user_id,
-users.first_name,
-users.last_name,
-order_items.order_id,
-order_items.product_id,
-products.name as product_name,
-products.brand as product_brand,
-order_items.sale_price,
-order_items.status
-FROM `ecommerce-data-project-444616.the_look_ecommerce_constant.order_items` as order_items
-LEFT JOIN `ecommerce-data-project-444616.the_look_ecommerce_constant.users` as users
-ON order_items.user_id = users.id
-LEFT JOIN `ecommerce-data-project-444616.the_look_ecommerce_constant.products` as products
-ON order_items.product_id = products.id
-ORDER BY order_items.user_id;
-"""
-df_orders = client.query_and_wait(ORDERS_QUERY).to_dataframe()
+@app.get("/metrics", response_class=PlainTextResponse)
+def getMetrics():
+    """Stage latency histograms, request latency histograms & cache counters in Prometheus text format"""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+####### ----------- RECOMMENDED PRODUCTS API FUNCTION ------------ ############
 
 # Create product & product list classes
 class Product(BaseModel):
@@ -95,128 +324,88 @@ class Product(BaseModel):
 class Products(BaseModel):
     products: List[Product]
 
+# Recommended product names by (customer id, recommendation data version), so a new snapshot never serves stale results
+recs_cache = ResultCache(max_size=int(os.getenv("RECS_CACHE_SIZE", 10000)), ttl=float(os.getenv("RECS_CACHE_TTL", 3600)))
+
+
+def customer_recommendations(data, customer_ids : list):
+    """Recommended product names of each customer, from the result cache or computed in one batch for the cache misses"""
+    recommendations, misses = {}, []
+    for customer_id in customer_ids:
+        cached = recs_cache.get((customer_id, data.version))
+        metrics.record_cache("recommendations", cached is not None)
+        if cached is None:
+            misses.append(customer_id)
+        else:
+            recommendations[customer_id] = cached
+
+    if misses:
+        # Get each customer's purchased products & the ids of the recommended products of every purchased product
+        purchases = {customer_id : data.order_index.purchases(customer_id) for customer_id in misses}
+        rec_dicts = recommend_batch(purchases, data.similarity_engine, data.embedding_index, product_neighbors=data.product_neighbors, k=5)
+        for customer_id in misses:
+            recommendations[customer_id] = recommended_names(rec_dicts[customer_id], data.product_names, data.product_positions)
+            recs_cache.put((customer_id, data.version), recommendations[customer_id])
+    return recommendations
+
+
+def warm_recommendations_cache(data, limit : int, batch_size : int=1000):
+    """Precompute the recommendations of the top upcoming shoppers once the CLV model is ready"""
+    clv_snapshot = clv_store.get()   # Waits for a running refit
+    if clv_snapshot is None:
+        return
+    start_time = datetime.now()
+    rows = clv_snapshot.ranked_rows(clv_store.min_pred_equity, clv_store.max_T)[:limit]
+    customer_ids = clv_snapshot.df_shoppers.shopper_id.values[rows].tolist()
+    for start in range(0, len(customer_ids), batch_size):
+        customer_recommendations(data, customer_ids[start:start + batch_size])
+    print(f"Warmed recommendations cache for {len(customer_ids)} upcoming shoppers - Time Taken = {datetime.now() - start_time}")
+
+
 @app.get("/recommend-products", response_model=Products)
 def recommendProducts(customer_id : int):
+    data = get_snapshot()
+
+    # Get the customer's recommended products, cached per data version
+    product_names = customer_recommendations(data, [customer_id])[customer_id]
 
-    # Get list of customer's purchased products
-    customer_purchases = df_orders[(df_orders.user_id == customer_id) & (df_orders.status != 'Cancelled')]
-    purchased_products = customer_purchases.product_name.tolist()
-
-    # Create dictionary containing customer's previously purchased products and the ids of the corresponding recommended products. 
-    rec_dict = {}
-    for query in purchased_products:
-        query_embedding = model.encode(query).reshape(1,-1)   # Create embedding for purchased product's name
-        query_dist = metric.pairwise(df_embedding.values[:,10:], query_embedding).flatten()   # Calculate distance between purchased product embedding & embeddings of all available products
-        query_dist_df = pd.DataFrame({'product_id' : df_products.id,    # Store distance results in a dataframe
-                                      'dist' : query_dist})
-        rec_dict[query] = query_dist_df.sort_values(by='dist').product_id.head(5).tolist()    # Add purchased product's top 5 most similar products to dictionary
-
-    # Create recommended products dataframe
-    recs_db = {"products": []}
-    for product in rec_dict.keys():
-        product_recs = df_products[df_products.id.isin(rec_dict[product])]
-        recs_db["products"].extend([Product(name=prod_name) for prod_name in product_recs.name.tolist()])
-
-    response = Products(products=recs_db["products"])
+    # Create recommended products list
+    with metrics.timer("serialize"):
+        response = Products(products=[Product(name=prod_name) for prod_name in product_names])
     return response
 
 
+class BatchRequest(BaseModel):
+    customer_ids : List[int]
+
+class CustomerProducts(BaseModel):
+    customer_id : int
+    products : List[Product]
+
+class BatchProducts(BaseModel):
+    results : List[CustomerProducts]
+
+RECS_BATCH_MAX = int(os.getenv("RECS_BATCH_MAX", 10000))
+
+@app.post("/recommend-products/batch", response_model=BatchProducts)
+def recommendProductsBatch(request : BatchRequest):
+    """Recommended products of many customers, sharing one similarity search across their unique purchased products"""
+    data = get_snapshot()
+    customer_ids = list(dict.fromkeys(request.customer_ids))   # Drop duplicate ids, keeping the request order
+    if len(customer_ids) > RECS_BATCH_MAX:
+        raise HTTPException(status_code=413, detail=f"At most {RECS_BATCH_MAX} customer ids per batch")
+
+    recommendations = customer_recommendations(data, customer_ids)
+
+    # Build the response as plain dicts, skipping per-product model validation
+    with metrics.timer("serialize"):
+        results = [{"customer_id" : customer_id, "products" : [{"name" : name} for name in recommendations[customer_id]]}
+                   for customer_id in customer_ids]
+        return JSONResponse(content={"results" : results})
+
+
 
 ########### ---------- UPCOMING SHOPPERS API FUNCTION ------------ #########
-# Get order values data
-print(f"Querying BigQuery for order values dataframe...")
-ORDER_VALUES_QUERY  = f"""
-WITH order_values AS (
-    SELECT 
-      order_id,
-      SUM(sale_price) as order_value
-    FROM `ecommerce-data-project-444616.the_look_ecommerce_constant.order_items`
-    GROUP BY order_id
-    ORDER BY order_id
-)
-SELECT 
-  orders.order_id,
-  orders.user_id,
-  users.first_name,
-  users.last_name,
-  users.email,
-  orders.created_at,
-  orders.status,
-  order_values.order_value
-FROM `ecommerce-data-project-444616.the_look_ecommerce_constant.orders` AS orders
-    LEFT JOIN `ecommerce-data-project-444616.the_look_ecommerce_constant.users` AS users ON orders.user_id = users.id
-    LEFT JOIN order_values on orders.order_id = order_values.order_id
-ORDER BY orders.order_id;
-"""
-df_order_values = client.query_and_wait(ORDER_VALUES_QUERY).to_dataframe()
-df_order_values['created_at'] = df_order_values.created_at.apply(lambda x : x.date())   # reformat 'created_at' column
-
-# Get users data
-print(f"Querying BigQuery for users dataframe...")
-USERS_QUERY  = f"""
-SELECT
-  *
-FROM `ecommerce-data-project-444616.the_look_ecommerce_constant.users`;
-"""
-df_users = client.query_and_wait(USERS_QUERY).to_dataframe()
-
-
-# Create Gamma-Gamma Model based prediction model class
-class PredictorGGF:
-    def __init__(self, df_summary):
-        self.model_name = "GGF"
-        self.df_summary = df_summary
-        self.correlation = self.df_summary[self.df_summary.frequency != 0][['monetary_value', 'frequency']].corr().values[0,1]
-
-        return print(f"Correlation between shopper frequency & monetary value is : {float(self.correlation):.5f}.")
-
-    def fit_bgf(self, penalty_coef : float=0.01):
-
-        self.bgf = lifetimes.BetaGeoFitter(penalty_coef)
-        self.bgf.fit(self.df_summary['frequency'],
-                    self.df_summary['recency'],
-                    self.df_summary['T'])
-
-        print(f"Beta-Gamma model successfully fitted")
-        return self.bgf.summary
-
-    def fit_ggf(self, penalty_coef : float=0.01):
-        assert self.correlation < 0.1, f"Correlation between frequency and monetary value for returning customers is {self.correlation} - this is quite high and may cause poor predictions"
-
-        self.ggf = lifetimes.GammaGammaFitter(penalty_coef)
-        self.ggf.fit(self.df_summary[self.df_summary.frequency != 0]['frequency'],
-                     self.df_summary[self.df_summary.frequency != 0]['monetary_value'])
-
-        print(f"Gamma-Gamma model successfully fitted")
-        if float(self.ggf.params_['q']) < 1:
-            print("Outliers in the data are causing the 'q' parameter for the Gamma-Gamma model to be < 1 therefore model predictions will fail.\nFix this by either removing outliers until you get 'q' > 1, or use raw monetary values to model CLV.")
-
-        return self.ggf.summary
-    
-    def predict_clv(self, time : int=12, discount_rate : float=0.1, freq : str="D"):
-        """Predict Customer Lifetime Value
-        Args:
-            time (float, optional) – the lifetime expected for the user in months. Default: 12
-            discount_rate (float, optional) – the monthly adjusted discount rate. Default: 0.01
-            freq (string, optional) – {“D”, “H”, “M”, “W”} for day, hour, month, week. This represents what unit of time your T is measure in.
-
-        Returns:
-            Series – Series object with customer ids as index and the estimated customer lifetime values as values
-        """
-
-        # Predict customer lifetime value
-        clv_preds_df = self.ggf.customer_lifetime_value(
-                            self.bgf,
-                            self.df_summary['frequency'],
-                            self.df_summary['recency'],
-                            self.df_summary['T'],
-                            self.df_summary['monetary_value'],
-                            time=time,
-                            discount_rate=discount_rate,
-                            freq=freq
-                        ).to_frame()
-        
-        return clv_preds_df
 
 # Create shopper & shopper list classes
 class Shopper(BaseModel):
@@ -230,43 +419,151 @@ class Shopper(BaseModel):
 
 class Shoppers(BaseModel):
     shoppers : List[Shopper]
+    next_cursor : Optional[str] = None
+    total : int
+
+SHOPPER_COLUMNS = list(Shopper.model_fields)
+NDJSON_CHUNK_ROWS = 1000
+
+
+def encode_cursor(version : str, offset : int, filters : list):
+    return base64.urlsafe_b64encode(json.dumps({"version" : version, "offset" : offset, "filters" : filters}).encode("utf-8")).decode("ascii")
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def decode_cursor(cursor : str):
+    """Version, offset & filters [min_pred_equity, max_T, country] of a cursor, 400 unless it has exactly that shape"""
+    try:
+        state = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        version, offset, filters = state["version"], state["offset"], state["filters"]
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if not (isinstance(version, str) and isinstance(offset, int) and not isinstance(offset, bool) and offset >= 0 and
+            isinstance(filters, list) and len(filters) == 3 and _is_number(filters[0]) and _is_number(filters[1]) and
+            (filters[2] is None or isinstance(filters[2], str))):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return version, offset, filters
+
 
 @app.get("/upcoming-shoppers", response_model=Shoppers)
-def upcomingShoppers():
-
-    # Get RFM summary data
-    df_rfm  = lifetimes.utils.summary_data_from_transaction_data(df_order_values, 'user_id', 'created_at',
-                                                                 freq='D', include_first_transaction = False)
-    df_rfm = pd.merge(df_rfm, df_order_values.groupby('user_id')['order_value'].agg(['mean', 'sum']), 
-                      how='left', on='user_id').rename(columns={'mean' : 'monetary_value', 'sum' : 'revenue'})
-    
-    # Fit prediction model to RFM data
-    model = PredictorGGF(df_rfm)
-    bgf_summary = model.fit_bgf(penalty_coef=0.01)
-    ggf_summary = model.fit_ggf(penalty_coef=0.01)
-
-    # Predict shoppers equities over next 24 months
-    pred_equity = model.predict_clv(time=24).rename(columns={'clv':'pred_equity'})   # Predict equity over next 24 months 
-
-    # Select shoppers whose first purchase was less than 90 days ago and who's predicted equity is positive
-    df_all = pd.merge(df_rfm, pred_equity, how = 'left', left_index=True, right_index=True)
-    upcoming_shoppers = df_all[(df_all.pred_equity > 0) & (df_all['T'] < 90)].sort_values(by='pred_equity', ascending=False).index.to_list()
-
-    shoppers_db = {"shoppers" : []}
-    for id in upcoming_shoppers:
-        shopper = df_users[df_users.id == id]
-        shoppers_db["shoppers"].append(Shopper(shopper_id=shopper.id.values[0],
-                                               name=shopper.first_name.values[0] + ' ' + shopper.last_name.values[0],
-                                               email=shopper.email.values[0],
-                                               age=shopper.age.values[0],
-                                               gender=shopper.gender.values[0],
-                                               country=shopper.country.values[0],
-                                               pred_equity=round(df_all.loc[id].pred_equity,2)))
-    response = Shoppers(shoppers=shoppers_db["shoppers"])
-    return response
-    
+def upcomingShoppers(limit : Optional[int] = Query(None, ge=1, le=10000), cursor : Optional[str] = None,
+                     min_pred_equity : Optional[float] = None, max_T : Optional[int] = None, country : Optional[str] = None,
+                     format : str = Query("json", pattern="^(json|ndjson)$")):
+    """Upcoming shoppers ranked by predicted equity, one page at a time
+    Args:
+        limit (int, optional) – page size. Default: 100 for "json", every remaining shopper for "ndjson"
+        cursor (str, optional) – `next_cursor` of the previous page, which also carries the filters of the first page
+        min_pred_equity, max_T, country (optional) – filters of the first page. Default: the CLV store's `min_pred_equity` & `max_T`
+        format (str, optional) – {"json", "ndjson"} one JSON document, or one shopper per line streamed in chunks. Default: "json"
+    """
+    get_snapshot()
+
+    # Get ranked upcoming shoppers from the fitted CLV model held in memory, without waiting for a running first fit
+    clv_snapshot = clv_store.current
+    if clv_snapshot is None:
+        raise HTTPException(status_code=503, detail="CLV model is not fitted yet")
+
+    if cursor is not None:
+        version, offset, filters = decode_cursor(cursor)
+        if version != clv_snapshot.version:
+            raise HTTPException(status_code=409, detail="The CLV model was refitted since this cursor was created - start again from the first page")
+    else:
+        offset = 0
+        filters = [clv_store.min_pred_equity if min_pred_equity is None else min_pred_equity,
+                   clv_store.max_T if max_T is None else max_T, country]
+    rows = clv_snapshot.ranked_rows(*filters)
+
+    # Serialize the page straight from the columnar table, skipping per-row model validation
+    limit = limit or (len(rows) if format == "ndjson" else 100)
+    page = rows[offset:offset + limit]
+    next_cursor = encode_cursor(clv_snapshot.version, offset + limit, filters) if offset + limit < len(rows) else None
+    df_shoppers = clv_snapshot.df_shoppers   # Rows are taken before the columns, so only the page is copied
+
+    if format == "ndjson":
+        def lines():
+            for start in range(0, len(page), NDJSON_CHUNK_ROWS):
+                yield df_shoppers.iloc[page[start:start + NDJSON_CHUNK_ROWS]][SHOPPER_COLUMNS].to_json(orient='records', lines=True) + "\n"
+        headers = {"X-Total-Count" : str(len(rows))}
+        if next_cursor is not None:
+            headers["X-Next-Cursor"] = next_cursor
+        return StreamingResponse(lines(), media_type="application/x-ndjson", headers=headers)
+
+    with metrics.timer("serialize"):
+        content = (f'{{"shoppers":{df_shoppers.iloc[page][SHOPPER_COLUMNS].to_json(orient="records")},'
+                   f'"next_cursor":{json.dumps(next_cursor)},"total":{len(rows)}}}')
+    return Response(content=content, media_type="application/json")
+
+
+
+########### ---------- CUSTOMER CLV API FUNCTION ------------ #########
+
+# Create CLV score classes
+class ClvHorizon(BaseModel):
+    months : int
+    expected_purchases : Optional[float]
+    pred_equity : Optional[float]
+
+class CustomerClv(BaseModel):
+    customer_id : int
+    prob_alive : Optional[float]
+    horizons : List[ClvHorizon]
+    precomputed : bool
+
+class CustomerClvBatch(BaseModel):
+    results : List[CustomerClv]
+    missing : List[int]
+
+CLV_BATCH_MAX = int(os.getenv("CLV_BATCH_MAX", 1000))
+
+
+def customer_clv(customer_ids : list):
+    """CLV scores of each customer from the scoring table of the fitted CLV model, scored on demand if missing from it"""
+    data = get_snapshot()
+    clv_snapshot = clv_store.current
+    if clv_snapshot is None:
+        raise HTTPException(status_code=503, detail="CLV model is not fitted yet")
+
+    def number(value):
+        return None if np.isnan(value) else float(value)   # e.g. no monetary value when every order of a customer is empty
+
+    df_scores = clv_snapshot.scores(customer_ids, df_rfm=data.df_rfm)
+    results = {}
+    for customer_id, row in zip(df_scores.index.tolist(), df_scores.to_dict('records')):
+        results[customer_id] = {"customer_id" : customer_id,
+                                "prob_alive" : number(row['prob_alive']),
+                                "horizons" : [{"months" : months,
+                                               "expected_purchases" : number(row[f'expected_purchases_{months}m']),
+                                               "pred_equity" : number(round(row[f'pred_equity_{months}m'], 2))} for months in clv_snapshot.horizons],
+                                "precomputed" : bool(row['precomputed'])}
+    return results
+
+
+@app.get("/customer-clv", response_model=CustomerClv)
+def customerClv(customer_id : int):
+    """Probability alive, expected purchases & predicted equity of one customer over each horizon"""
+    results = customer_clv([customer_id])
+    if customer_id not in results:
+        raise HTTPException(status_code=404, detail=f"Customer {customer_id} has no orders")
+    return JSONResponse(content=results[customer_id])
+
+
+@app.post("/customer-clv/batch", response_model=CustomerClvBatch)
+def customerClvBatch(request : BatchRequest):
+    """CLV scores of many customers in request order, with the ids of customers that have no orders"""
+    customer_ids = list(dict.fromkeys(request.customer_ids))   # Drop duplicate ids, keeping the request order
+    if len(customer_ids) > CLV_BATCH_MAX:
+        raise HTTPException(status_code=413, detail=f"At most {CLV_BATCH_MAX} customer ids per batch")
+
+    results = customer_clv(customer_ids)
+    with metrics.timer("serialize"):
+        return JSONResponse(content={"results" : [results[customer_id] for customer_id in customer_ids if customer_id in results],
+                                     "missing" : [customer_id for customer_id in customer_ids if customer_id not in results]})
 
 
 
 if __name__=="__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    workers = int(os.getenv("WEB_CONCURRENCY", 1))   # Set SHARED_STORE_DIR too, so workers share one copy of the tables
+    uvicorn.run("main:app" if workers > 1 else app, host="0.0.0.0", port=8000, workers=workers)
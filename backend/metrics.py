@@ -0,0 +1,142 @@
+# Lightweight latency histograms & counters, exposed in Prometheus text format & written as JSON timing reports
+import functools
+import json
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds in seconds, from sub-millisecond lookups up to multi-minute model fits
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, math.inf)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels_text(labels : tuple):
+    return ",".join(f'{name}="{_escape(value)}"' for name, value in labels)
+
+
+class Histogram:
+    def __init__(self, name : str, help : str, buckets : tuple=BUCKETS):
+        """Cumulative histogram of observed values for every combination of label values"""
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self._series = {}   # labels -> [bucket counts, count, sum, max]
+        self._lock = threading.Lock()
+
+    def observe(self, value : float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0, 0.0, 0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += 1
+            series[2] += value
+            series[3] = max(series[3], value)
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the wall time of the `with` block"""
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start_time, **labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (bucket_counts, count, total, _) in sorted(self._series.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, bucket_counts):
+                    cumulative += bucket_count
+                    le = "+Inf" if bound == math.inf else repr(bound)
+                    lines.append(f'{self.name}_bucket{{{_labels_text(key + (("le", le),))}}} {cumulative}')
+                lines.append(f"{self.name}_sum{{{_labels_text(key)}}} {total}")
+                lines.append(f"{self.name}_count{{{_labels_text(key)}}} {count}")
+        return lines
+
+    def report(self):
+        with self._lock:
+            return {_labels_text(key) : {"count" : count, "total_seconds" : total, "mean_seconds" : total / count, "max_seconds" : maximum}
+                    for key, (_, count, total, maximum) in sorted(self._series.items())}
+
+
+class Counter:
+    def __init__(self, name : str, help : str):
+        """Monotonic counter for every combination of label values"""
+        self.name = name
+        self.help = help
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount : float=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            lines.extend(f"{self.name}{{{_labels_text(key)}}} {value}" for key, value in sorted(self._values.items()))
+        return lines
+
+    def report(self):
+        with self._lock:
+            return {_labels_text(key) : value for key, value in sorted(self._values.items())}
+
+
+#### Metrics shared by the API & the batch jobs
+STAGE_SECONDS = Histogram("stage_duration_seconds", "Wall time of each processing stage")
+REQUEST_SECONDS = Histogram("http_request_duration_seconds", "Wall time of each API request")
+CACHE_REQUESTS = Counter("cache_requests_total", "Lookups in each cache")
+CACHE_MISSES = Counter("cache_misses_total", "Lookups in each cache that missed")
+METRICS = (STAGE_SECONDS, REQUEST_SECONDS, CACHE_REQUESTS, CACHE_MISSES)
+
+
+def timer(stage : str):
+    """Time a stage, e.g. `with timer("similarity_search"): ...`"""
+    return STAGE_SECONDS.time(stage=stage)
+
+
+def record(stage : str, elapsed):
+    """Record the wall time of a stage measured by the caller, in seconds or as a timedelta"""
+    STAGE_SECONDS.observe(elapsed.total_seconds() if hasattr(elapsed, "total_seconds") else elapsed, stage=stage)
+
+
+def measure(stage : str):
+    """Decorator timing every call of a function as a stage"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def record_cache(cache : str, hit : bool):
+    CACHE_REQUESTS.inc(cache=cache)
+    if not hit:
+        CACHE_MISSES.inc(cache=cache)
+
+
+def render():
+    """Every metric in the Prometheus text exposition format"""
+    return "\n".join(line for metric in METRICS for line in metric.render()) + "\n"
+
+
+def write_report(path : str, **extra):
+    """Write every metric as a JSON timing report, e.g. at the end of a batch job"""
+    report = dict(extra, **{metric.name : metric.report() for metric in METRICS})
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Saved timing report to {path}")
+    return report
@@ -1,49 +1,94 @@
-# Import modules to acces GCP
+# Import modules to access the data (BigQuery & GCS, or local files - see DATA_BACKEND)
 import os
-from google.cloud import storage, bigquery
-storage_client = storage.Client()
-bigquery_client = bigquery.Client()
+from data_sources import get_data_source
+source = get_data_source()
 
 # Import automation modules
 from datetime import datetime
 
 # Import packages to create product embeddings
-import pandas as pd
-from sentence_transformers import SentenceTransformer
-from sklearn.metrics import DistanceMetric
+import numpy as np
 import io
+from encoders import embedding_model, get_encoder
+from artifacts import EmbeddingArtifact, download_embedding_artifact, plan_refresh, upload_embedding_artifact
+from recommender import build_neighbor_table, neighbor_recall
+import metrics
 
 
-#### Create new product embeddings dataframe
-model = SentenceTransformer("all-mpnet-base-v2")
-metric = DistanceMetric.get_metric('euclidean')
-QUERY  = f"""
-SELECT *
-FROM `ecommerce-data-project-444616.the_look_ecommerce_constant.products`;
-"""
-df_products = bigquery_client.query_and_wait(QUERY).to_dataframe()
+#### Create new product embeddings artifact
+MODEL_NAME = embedding_model()   # EMBEDDING_MODEL, e.g. a smaller model - the API must use the same one
+ARTIFACT_NAME = f"product_embeddings_{MODEL_NAME}"
+ARTIFACT_DIR = os.getenv("ARTIFACT_DIR", "/tmp/artifacts")
+EMBEDDING_DTYPE = os.getenv("EMBEDDING_DTYPE", "float32")   # 'float16' halves the artifact size
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", 64))
+FULL_REFRESH = os.getenv("FULL_REFRESH", "0") == "1"   # Re-encode every product instead of only new & changed ones
+TIMING_REPORT = os.getenv("TIMING_REPORT", "/tmp/product-embeddings-timings.json")
+start_time = datetime.now()
+model = get_encoder()   # Runtime selected by ENCODER_BACKEND
+metrics.record("load_model", datetime.now() - start_time)
+start_time = datetime.now()
+df_products = source.query("PRODUCTS")
+metrics.record("query_products", datetime.now() - start_time)
+
+# Get previous embeddings artifact so unchanged products are not re-encoded
+previous_artifact = None
+if not FULL_REFRESH and source.exists(f"{ARTIFACT_NAME}.json"):
+    print(f"Downloading previous product embeddings...")
+    previous_artifact = download_embedding_artifact(source, os.path.join(ARTIFACT_DIR, "previous"), MODEL_NAME)
+reuse_rows = plan_refresh(previous_artifact, df_products.id.to_list(), df_products.name.to_list())   # Previous row of every unchanged product, -1 for new & changed products
+encode_rows = np.flatnonzero(reuse_rows < 0)
+n_deleted = 0 if previous_artifact is None else len(set(previous_artifact.product_ids.tolist()) - set(df_products.id.to_list()))
+print(f"{len(df_products) - len(encode_rows)} unchanged, {len(encode_rows)} new or changed & {n_deleted} deleted products")
 
 print(f"Creating Product Embeddings...")
 start_time = datetime.now()
-embedding_arr = model.encode(df_products['name'].to_list())
-df_embedding = pd.DataFrame(embedding_arr)
-df_embedding.columns = ['product-embedding-'+str(i) for i in range(embedding_arr.shape[1])]
-df_embedding = pd.concat([df_products, df_embedding], axis=1)
+embedding_arr = np.empty((len(df_products), model.dimension), dtype=np.float32)
+if previous_artifact is not None and len(encode_rows) < len(df_products):
+    embedding_arr[reuse_rows >= 0] = previous_artifact.embeddings[reuse_rows[reuse_rows >= 0]]   # Merge in unchanged embeddings, deleted products are dropped
+names = df_products['name'].to_numpy()
+chunk_size = EMBEDDING_BATCH_SIZE * 32
+for start in range(0, len(encode_rows), chunk_size):   # Encode new & changed products in chunks
+    chunk_rows = encode_rows[start:start + chunk_size]
+    embedding_arr[chunk_rows] = model.encode(names[chunk_rows].tolist(), batch_size=EMBEDDING_BATCH_SIZE)
+    print(f"Encoded {min(start + chunk_size, len(encode_rows))}/{len(encode_rows)} products")
+metrics.record("encode", datetime.now() - start_time)
 print(f"Finished creating product embeddings - Time Taken = {datetime.now() - start_time}")
 
-print(f"Saving Product Embeddings to CSV Buffer...")
+if len(encode_rows) == 0 and n_deleted == 0:
+    print(f"Product catalog is unchanged - keeping the current product embeddings & neighbors")
+    metrics.write_report(TIMING_REPORT, job="product-embeddings", products=len(df_products), encoded=0)
+    raise SystemExit(0)
+
+print(f"Creating Product Neighbor Table...")
 start_time = datetime.now()
-csv_buffer = io.BytesIO()
-df_embedding.to_csv(csv_buffer, index=False)  # Convert DataFrame to CSV
-csv_buffer.seek(0)
+N_NEIGHBORS = 5
+df_neighbors = build_neighbor_table(embedding_arr, df_products.id.values, k=N_NEIGHBORS)   # Top 5 most similar products for every product
+recall = neighbor_recall(embedding_arr, df_products.id.values, df_neighbors)   # Check precomputed neighbors against an exact search
+metrics.record("neighbor_table", datetime.now() - start_time)
+print(f"Finished creating product neighbor table (recall@{N_NEIGHBORS} = {recall:.4f}) - Time Taken = {datetime.now() - start_time}")
+assert recall >= 0.99, f"Product neighbor table recall is {recall:.4f} - the precomputed neighbors do not match an exact search"
+
+print(f"Saving Product Embeddings Artifact...")
+start_time = datetime.now()
+os.makedirs(ARTIFACT_DIR, exist_ok=True)
+artifact = EmbeddingArtifact(df_products.id.values, df_products.name.to_list(), embedding_arr, MODEL_NAME)
+artifact.save(os.path.join(ARTIFACT_DIR, ARTIFACT_NAME), dtype=EMBEDDING_DTYPE)   # Binary .npy matrix + .json sidecar with schema header & product ids
+neighbors_buffer = io.BytesIO()
+df_neighbors.to_csv(neighbors_buffer, index=False)
+neighbors_buffer.seek(0)
+metrics.record("save", datetime.now() - start_time)
 print(f"Finished saving product embeddings - Time Taken = {datetime.now() - start_time}")
 
 
-#### Upload new embeddings dataframe to bucket
-print(f"Connecting to storage bucket...")
-bucket = storage_client.get_bucket("bucket-quickstart_ecommerce-data-project-444616")
-blob = bucket.blob("product_embeddings_all-mpnet-base-v2.csv")
+#### Upload new embeddings artifact to bucket
 print(f"Uploading product embeddings to storage bucket...")
 start_time = datetime.now()
-blob.upload_from_file(csv_buffer, content_type="text/csv", timeout=600)
-print(f"Finished uploading product embeddings - Time Taken = {datetime.now() - start_time}")
\ No newline at end of file
+upload_embedding_artifact(source, ARTIFACT_DIR, MODEL_NAME)
+metrics.record("upload", datetime.now() - start_time)
+print(f"Finished uploading product embeddings - Time Taken = {datetime.now() - start_time}")
+print(f"Uploading product neighbors to storage bucket...")
+start_time = datetime.now()
+source.upload_bytes(f"product_neighbors_{MODEL_NAME}.csv", neighbors_buffer, content_type="text/csv")
+metrics.record("upload", datetime.now() - start_time)
+print(f"Finished uploading product neighbors - Time Taken = {datetime.now() - start_time}")
+metrics.write_report(TIMING_REPORT, job="product-embeddings", products=len(df_products), encoded=len(encode_rows))
\ No newline at end of file
@@ -0,0 +1,335 @@
+# Import packages to search product embeddings
+import functools
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+from sklearn.metrics import DistanceMetric
+
+import metrics
+
+
+def _top_k(embeddings, sq_norms, queries, k : int):
+    """Find the k rows of `embeddings` closest to each query by euclidean distance.
+
+    Returns:
+        tuple – (row indices, distances) arrays of shape (n_queries, k), sorted by distance
+    """
+    # ||x - q||^2 = ||x||^2 - 2 x.q + ||q||^2, so a single matrix product gives every distance
+    with metrics.timer("distance_matrix"):
+        q_norms = np.einsum('ij,ij->i', queries, queries)
+        sq_dist = sq_norms[None, :] - 2 * (queries @ embeddings.T) + q_norms[:, None]
+        np.maximum(sq_dist, 0, out=sq_dist)   # remove small negative values caused by rounding
+
+    # Select the k smallest distances per query without fully sorting, then sort only those k
+    with metrics.timer("top_k"):
+        rows = np.argpartition(sq_dist, k - 1, axis=1)[:, :k]
+        row_dist = np.take_along_axis(sq_dist, rows, axis=1)
+        order = np.argsort(row_dist, axis=1)
+        return np.take_along_axis(rows, order, axis=1), np.sqrt(np.take_along_axis(row_dist, order, axis=1))
+
+
+class SimilarityEngine:
+    def __init__(self, embeddings, product_ids):
+        """Exact euclidean nearest-neighbor search over product embeddings
+        Args:
+            embeddings (array) – product embedding matrix with one row per product
+            product_ids (array) – product ids aligned with the rows of `embeddings`
+        """
+        self.embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        self.product_ids = np.asarray(product_ids)
+        self.sq_norms = np.einsum('ij,ij->i', self.embeddings, self.embeddings)   # Precomputed once so each search is a single matrix product
+
+    @metrics.measure("similarity_search")
+    def search(self, queries, k : int=5, chunk_size : int=1024):
+        """Find the k most similar products for every query embedding
+        Args:
+            queries (array) – query embedding matrix with one row per query
+            k (int, optional) – number of products returned per query. Default: 5
+            chunk_size (int, optional) – number of queries searched per matrix product. Default: 1024
+
+        Returns:
+            tuple – (product ids, distances) arrays of shape (n_queries, k), ordered by distance
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        k = min(k, self.embeddings.shape[0])
+        rows = np.empty((queries.shape[0], k), dtype=np.int64)
+        dist = np.empty((queries.shape[0], k), dtype=np.float32)
+        for start in range(0, queries.shape[0], chunk_size):   # Search in chunks to bound the size of the distance matrix
+            stop = start + chunk_size
+            rows[start:stop], dist[start:stop] = _top_k(self.embeddings, self.sq_norms, queries[start:stop], k)
+
+        return self.product_ids[rows], dist
+
+
+def build_neighbor_table(embeddings, product_ids, k : int=5):
+    """Build a table of every product's k most similar products
+    Args:
+        embeddings (array) – product embedding matrix with one row per product
+        product_ids (array) – product ids aligned with the rows of `embeddings`
+        k (int, optional) – number of neighbors stored for each product. Default: 5
+
+    Returns:
+        DataFrame – one row per (product_id, rank) with the neighboring product's id and distance
+    """
+    engine = SimilarityEngine(embeddings, product_ids)
+    neighbor_ids, neighbor_dist = engine.search(engine.embeddings, k)
+
+    return pd.DataFrame({'product_id' : np.repeat(engine.product_ids, neighbor_ids.shape[1]),
+                         'rank' : np.tile(np.arange(neighbor_ids.shape[1]), neighbor_ids.shape[0]),
+                         'neighbor_id' : neighbor_ids.ravel(),
+                         'dist' : neighbor_dist.ravel()})
+
+
+def neighbor_recall(embeddings, product_ids, df_neighbors, n_samples : int=500, seed : int=0, tol : float=1e-4):
+    """Compare the neighbor table against an exact search over a random sample of products
+    Args:
+        embeddings (array) – product embedding matrix used to build `df_neighbors`
+        product_ids (array) – product ids aligned with the rows of `embeddings`
+        df_neighbors (DataFrame) – neighbor table created by `build_neighbor_table`
+        n_samples (int, optional) – number of products to check. Default: 500
+        seed (int, optional) – random seed used to sample products. Default: 0
+        tol (float, optional) – distance tolerance used to accept ties with the k-th exact neighbor. Default: 1e-4
+
+    Returns:
+        float – fraction of stored neighbors that are among the exact k nearest products
+    """
+    metric = DistanceMetric.get_metric('euclidean')
+    embeddings = np.asarray(embeddings, dtype=np.float64)
+    id_index = pd.Index(product_ids)
+    neighbors = df_neighbors.sort_values(['product_id', 'rank']).groupby('product_id').neighbor_id.agg(list)
+
+    rng = np.random.default_rng(seed)
+    sample_rows = rng.choice(embeddings.shape[0], size=min(n_samples, embeddings.shape[0]), replace=False)
+    hits, total = 0, 0
+    for row in sample_rows:
+        exact_dist = metric.pairwise(embeddings, embeddings[row].reshape(1, -1)).flatten()   # Exact distance to every product
+        stored = id_index.get_indexer(neighbors[id_index[row]])
+        kth_dist = np.partition(exact_dist, len(stored) - 1)[len(stored) - 1]
+        hits += int((exact_dist[stored] <= kth_dist + tol).sum())   # Products tied with the k-th neighbor count as hits
+        total += len(stored)
+
+    return hits / total
+
+
+def neighbor_lookup(df_neighbors):
+    """Convert a neighbor table into a dictionary of product id -> neighbor ids ordered by similarity"""
+    return df_neighbors.sort_values(['product_id', 'rank']).groupby('product_id').neighbor_id.agg(list).to_dict()
+
+
+class EmbeddingIndex:
+    def __init__(self, embeddings, product_ids, encode, cache_size : int=4096):
+        """Look up query embeddings for purchased products
+        Args:
+            embeddings (array) – stored product embedding matrix with one row per product
+            product_ids (array) – product ids aligned with the rows of `embeddings`
+            encode (callable) – function that embeds a single product name, e.g. `Encoder.encode`
+            cache_size (int, optional) – maximum number of encoded names kept for products outside the catalog. Default: 4096
+        """
+        self.embeddings = embeddings
+        self.rows = {product_id : row for row, product_id in enumerate(np.asarray(product_ids).tolist())}
+        self.encode = encode
+        self._encode_cached = functools.lru_cache(maxsize=cache_size)(self._encode)
+
+    def _encode(self, name : str):
+        metrics.CACHE_MISSES.inc(cache="encode")   # Only called when the name is not cached
+        with metrics.timer("encode"):
+            embedding = np.asarray(self.encode(name), dtype=np.float32)
+        embedding.setflags(write=False)   # Cached arrays are shared between requests
+        return embedding
+
+    def query_vector(self, product_id : int, name : str):
+        """Return the stored embedding of a catalog product, or the (cached) encoding of its name otherwise"""
+        row = self.rows.get(product_id)
+        if row is not None:
+            return self.embeddings[row]
+        metrics.CACHE_REQUESTS.inc(cache="encode")
+        return self._encode_cached(name)
+
+    def cache_info(self):
+        return self._encode_cached.cache_info()
+
+
+def recommend_products(product_ids, names, engine, embedding_index, product_neighbors=None, k : int=5):
+    """Find the most similar products to each of a customer's purchased products
+    Args:
+        product_ids (list) – ids of the customer's purchased products
+        names (list) – names of the customer's purchased products, aligned with `product_ids`
+        engine (SimilarityEngine) – similarity search over the product embeddings
+        embedding_index (EmbeddingIndex) – lookup used to get the query embedding of each purchased product
+        product_neighbors (dict, optional) – precomputed product id -> neighbor ids lookup. Default: None
+        k (int, optional) – number of recommended products per purchased product. Default: 5
+
+    Returns:
+        dict – purchased product name -> ids of its recommended products, in purchase order
+    """
+    # Remove duplicate purchases, and use the neighbor table for products that are in it
+    rec_dict, queries = {}, {}
+    for product_id, name in zip(product_ids, names):
+        if name in rec_dict:
+            continue
+        if product_neighbors is not None:
+            metrics.record_cache("neighbor_table", product_id in product_neighbors)
+        if product_neighbors is not None and product_id in product_neighbors:
+            rec_dict[name] = product_neighbors[product_id][:k]
+        else:
+            rec_dict[name] = None
+            queries[name] = product_id
+
+    # Search for all remaining purchased products at once
+    if queries:
+        query_embeddings = np.vstack([embedding_index.query_vector(product_id, name) for name, product_id in queries.items()])
+        neighbor_ids, _ = engine.search(query_embeddings, k)
+        for name, ids in zip(queries, neighbor_ids.tolist()):
+            rec_dict[name] = ids
+
+    return rec_dict
+
+
+class OrderIndex:
+    def __init__(self, df_orders):
+        """Per-customer index of purchased products
+        Args:
+            df_orders (DataFrame) – non-cancelled order items with 'user_id', 'product_id' and 'product_name' columns, e.g. the
+                "ORDERS" query. Items whose optional 'status' column is 'Cancelled' are removed.
+
+        The product ids are stored in one compact array grouped by customer, with `offsets[i]:offsets[i+1]` holding the purchases of `user_ids[i]` (CSR layout).
+        """
+        if 'status' in df_orders:
+            df_orders = df_orders[df_orders.status != 'Cancelled']
+        user_ids = df_orders.user_id.to_numpy(dtype=np.int64)
+        order = np.argsort(user_ids, kind='stable')   # Group by customer, keeping the order of the query rows within each customer
+
+        self.product_ids = df_orders.product_id.to_numpy(dtype=np.int32)[order]
+        user_ids, starts = np.unique(user_ids[order], return_index=True)
+        self.user_ids = user_ids.astype(np.int32) if len(user_ids) == 0 or user_ids[-1] <= np.iinfo(np.int32).max else user_ids
+        self.offsets = np.append(starts, len(order)).astype(np.int64)
+        unique_products = df_orders.drop_duplicates('product_id')
+        self.product_names = dict(zip(unique_products.product_id.tolist(), unique_products.product_name.tolist()))
+
+    @classmethod
+    def from_arrays(cls, user_ids, offsets, product_ids, product_names : dict):
+        """Create an index from the arrays of another index, e.g. memory-mapped from a `TableStore`"""
+        index = cls.__new__(cls)
+        index.user_ids, index.offsets, index.product_ids, index.product_names = user_ids, offsets, product_ids, product_names
+        return index
+
+    def __len__(self):
+        return len(self.user_ids)
+
+    def product_ids_for(self, customer_id : int):
+        """Return the ids of a customer's non-cancelled purchased products"""
+        i = np.searchsorted(self.user_ids, customer_id)
+        if i == len(self.user_ids) or self.user_ids[i] != customer_id:
+            return self.product_ids[:0]
+        return self.product_ids[self.offsets[i]:self.offsets[i + 1]]
+
+    @metrics.measure("order_lookup")
+    def purchases(self, customer_id : int):
+        """Return the (product ids, product names) lists of a customer's non-cancelled purchased products"""
+        product_ids = self.product_ids_for(customer_id).tolist()
+        return product_ids, [self.product_names[product_id] for product_id in product_ids]
+
+
+def recommend_batch(purchases : dict, engine, embedding_index, product_neighbors=None, k : int=5):
+    """Find recommended products for many customers with one similarity search over their unique purchased products
+    Args:
+        purchases (dict) – customer id -> (purchased product ids, purchased product names), e.g. from `OrderIndex.purchases`
+        engine (SimilarityEngine) – similarity search over the product embeddings
+        embedding_index (EmbeddingIndex) – lookup used to get the query embedding of each purchased product
+        product_neighbors (dict, optional) – precomputed product id -> neighbor ids lookup. Default: None
+        k (int, optional) – number of recommended products per purchased product. Default: 5
+
+    Returns:
+        dict – customer id -> {purchased product name -> ids of its recommended products}, like `recommend_products`
+    """
+    # Search every unique purchased product once
+    unique_products = {}
+    for product_ids, names in purchases.values():
+        for product_id, name in zip(product_ids, names):
+            unique_products.setdefault(name, product_id)
+    product_recs = recommend_products(list(unique_products.values()), list(unique_products.keys()),
+                                      engine, embedding_index, product_neighbors=product_neighbors, k=k)
+
+    return {customer_id : {name : product_recs[name] for name in names}
+            for customer_id, (_, names) in purchases.items()}
+
+
+def product_lookups(df_products):
+    """Product id -> name & product id -> row in the products table, used to turn recommended ids into names"""
+    product_ids = df_products.id.tolist()
+    return dict(zip(product_ids, df_products.name.tolist())), {id : position for position, id in enumerate(product_ids)}
+
+
+def recommended_names(rec_dict : dict, product_names : dict, product_positions : dict):
+    """Names of the recommended products of one customer, grouped by purchased product & ordered like the products table
+    Args:
+        rec_dict (dict) – purchased product name -> ids of its recommended products, as returned by `recommend_products`
+        product_names (dict) – product id -> product name
+        product_positions (dict) – product id -> row of the product in the products table
+    """
+    names = []
+    for rec_ids in rec_dict.values():
+        rec_ids = sorted((id for id in rec_ids if id in product_positions), key=product_positions.get)   # Same order as the products table
+        names.extend(product_names[id] for id in rec_ids)
+    return names
+
+
+def recommendation_rows(shoppers : list, rec_dicts : dict, product_names : dict, product_positions : dict, n_recs : int=5):
+    """Create spreadsheet rows of [first name, last name, email, top `n_recs` recommended product names] for shoppers
+    Args:
+        shoppers (list) – (shopper id, full name, email) tuples
+        rec_dicts (dict) – shopper id -> recommendations, as returned by `recommend_batch`
+        product_names (dict) – product id -> product name
+        product_positions (dict) – product id -> row of the product in the products table, used to order recommendations
+        n_recs (int, optional) – number of recommended products per shopper. Default: 5
+    """
+    rows = []
+    for shopper_id, name, email in shoppers:
+        recs = recommended_names(rec_dicts.get(shopper_id, {}), product_names, product_positions)
+        recs = (recs + [''] * n_recs)[:n_recs]   # Pad shoppers with fewer recommendations
+        rows.append([name.split(' ')[0], name.split(' ')[1], email] + recs)
+    return rows
+
+
+class ResultCache:
+    def __init__(self, max_size : int=10000, ttl : float=3600):
+        """Bounded LRU cache whose entries also expire `ttl` seconds after they were stored
+        Args:
+            max_size (int, optional) – maximum number of entries, the least recently used entry is evicted first. Default: 10000
+            ttl (float, optional) – seconds an entry stays valid. Default: 3600
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()   # key -> (value, expiry time)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the cached value of `key`, or None if it is missing or expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
@@ -1,123 +1,107 @@
-# Import packages to connect to Google Storage
+# Import modules to access the data (BigQuery & GCS, or local files - see DATA_BACKEND)
 import os
-from google.cloud import storage, bigquery
-storage_client = storage.Client()
-bigquery_client  = bigquery.Client()
-
-# Import packages to connect to Google Sheets API
-import gspread
-from google.oauth2.service_account import Credentials
-import json
-scopes = ["https://www.googleapis.com/auth/spreadsheets"]
-secret = json.loads(os.getenv('GCP_SERVICE_ACCOUNT'))
-creds = Credentials.from_service_account_info(secret, scopes=scopes)
-client = gspread.authorize(creds)
+from data_sources import get_data_source
+source = get_data_source()
 
 # Import packages to create product recommendations
 from datetime import datetime
-from sentence_transformers import SentenceTransformer
-from sklearn.metrics import DistanceMetric
 import pandas as pd
 import io
-import requests
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from artifacts import download_embedding_artifact
+from encoders import embedding_model, get_encoder
+from recommender import EmbeddingIndex, OrderIndex, SimilarityEngine, neighbor_lookup, product_lookups, recommend_batch, recommendation_rows
+import metrics
 
 # Get list of upcoming shoppers
 print(f"Downloading upcoming shoppers data...")
-bucket = storage_client.get_bucket("bucket-quickstart_ecommerce-data-project-444616")
-content = bucket.blob("upcoming_shoppers.csv").download_as_bytes() # Download the upcoming shoppers file
+load_start_time = datetime.now()
+content = source.download_bytes("upcoming_shoppers.csv") # Download the upcoming shoppers file
 df_upcoming_shoppers = pd.read_csv(io.BytesIO(content)) # Convert to Pandas DataFrame
 
-# Get product embeddings dataframe
+# Get product embeddings artifact
 print(f"Downloading product embeddings data...")
-content = bucket.blob("product_embeddings_all-mpnet-base-v2.csv").download_as_bytes() # Download the embeddings file
-df_embedding = pd.read_csv(io.BytesIO(content)) # Convert to Pandas DataFrame
+MODEL_NAME = embedding_model()
+ARTIFACT_DIR = os.getenv("ARTIFACT_DIR", "/tmp/artifacts")
+embedding_artifact = download_embedding_artifact(source, ARTIFACT_DIR, MODEL_NAME) # Download & memory-map the embedding matrix
+content = source.download_bytes(f"product_neighbors_{MODEL_NAME}.csv")
+product_neighbors = neighbor_lookup(pd.read_csv(io.BytesIO(content)))   # Dictionary of product id -> top 5 most similar product ids
 
 # Get products dataframe
-print(f"Querying BigQuery for products dataframe")
-PRODUCTS_QUERY  = f"""
-SELECT *
-FROM `ecommerce-data-project-444616.the_look_ecommerce_constant.products`;
-"""
-df_products = bigquery_client.query_and_wait(PRODUCTS_QUERY).to_dataframe()
+print(f"Querying {source.name} for products dataframe")
+df_products = source.query("PRODUCTS")
 
 # Get orders dataframe
-print(f"Querying BigQuery for orders dataframe")
-ORDERS_QUERY  = f"""
-SELECT
-order_items.user_id,
-users.first_name,
-users.last_name,
-order_items.order_id,
-order_items.product_id,
-products.name as product_name,
-products.brand as product_brand,
-order_items.sale_price,
-order_items.status
-FROM `ecommerce-data-project-444616.the_look_ecommerce_constant.order_items` as order_items
-LEFT JOIN `ecommerce-data-project-444616.the_look_ecommerce_constant.users` as users
-ON order_items.user_id = users.id
-LEFT JOIN `ecommerce-data-project-444616.the_look_ecommerce_constant.products` as products
-ON order_items.product_id = products.id
-ORDER BY order_items.user_id;
-"""
-df_orders = bigquery_client.query_and_wait(ORDERS_QUERY).to_dataframe()
+print(f"Querying {source.name} for orders dataframe")
+df_orders = source.query("ORDERS")
+order_index = OrderIndex(df_orders)   # Customer id -> non-cancelled purchased product ids
 
 # Load embedding model
 print(f"Loading LLM for product recommendations ...")
-model = SentenceTransformer("all-mpnet-base-v2")
-print(f"Loading metric for product recommendations ...")
-metric = DistanceMetric.get_metric('euclidean')
-
-# Define product recommendation function
-def recommendProducts(customer_id : int):
-
-    # Get list of customer's purchased products
-    customer_purchases = df_orders[(df_orders.user_id == customer_id) & (df_orders.status != 'Cancelled')]
-    purchased_products = customer_purchases.product_name.tolist()
-
-    # Create dictionary containing customer's previously purchased products and the ids of the corresponding recommended products. 
-    rec_dict = {}
-    for query in purchased_products:
-        query_embedding = model.encode(query).reshape(1,-1)   # Create embedding for purchased product's name
-        query_dist = metric.pairwise(df_embedding.values[:,9:], query_embedding).flatten()   # Calculate distance between purchased product embedding & embeddings of all available products
-        query_dist_df = pd.DataFrame({'product_id' : df_products.id,    # Store distance results in a dataframe
-                                      'dist' : query_dist})
-        rec_dict[query] = query_dist_df.sort_values(by='dist').product_id.head(5).tolist()    # Add purchased product's top 5 most similar products to dictionary
-
-    # Create recommended products dataframe
-    recs_db = {"products": []}
-    for product in rec_dict.keys():
-        product_recs = df_products[df_products.id.isin(rec_dict[product])]
-        recs_db["products"].extend(product_recs.name.tolist())
-
-    return recs_db
+model = get_encoder()   # Runtime selected by ENCODER_BACKEND
+print(f"Indexing product embeddings ...")
+embedding_index = EmbeddingIndex(embedding_artifact.embeddings, embedding_artifact.product_ids, model.encode)   # Product id -> stored embedding, with an LRU cache for names outside the catalog
+similarity_engine = SimilarityEngine(embedding_artifact.embeddings, embedding_artifact.product_ids)   # Contiguous float32 embedding matrix for batched similarity search
+metrics.record("load_data_and_model", datetime.now() - load_start_time)
 
 # Create dataframe with product recommendations for upcoming shoppers
 print(f"Creating Recommendations Dataframe...")
 start_time = datetime.now()
-recs_data = {'First Name' : [],
-             'Last Name' : [],
-             'Recipient' : [],
-             'Rec Prod1' : [], 'Rec Prod2' : [], 'Rec Prod3' : [], 'Rec Prod4' : [], 'Rec Prod5' : []}
-
-for row, row_vals in df_upcoming_shoppers.iterrows():
-    recs_data['First Name'].append(row_vals['name'].split(' ')[0])
-    recs_data['Last Name'].append(row_vals['name'].split(' ')[1])
-    recs_data['Recipient'].append(row_vals['email'])
-
-    shopper_id = row_vals['shopper_id']
-    recs = recommendProducts(shopper_id)['products']
-    for rec_num in range(5):
-        recs_data[f"Rec Prod{rec_num+1}"].append(recs[rec_num])
-
-recs_df = pd.DataFrame(recs_data)
+RECS_WORKERS = int(os.getenv("RECS_WORKERS", os.cpu_count() or 1))
+RECS_CHUNK_SIZE = 2000
+
+# Search every unique product purchased by the upcoming shoppers in one vectorized pass
+shopper_ids = df_upcoming_shoppers.shopper_id.tolist()
+purchases = {shopper_id : order_index.purchases(shopper_id) for shopper_id in shopper_ids}
+rec_dicts = recommend_batch(purchases, similarity_engine, embedding_index, product_neighbors=product_neighbors, k=5)
+metrics.record("recommend_batch", datetime.now() - start_time)
+print(f"Found recommendations for {len(purchases)} shoppers - Time Taken = {datetime.now() - start_time}")
+
+# Create the spreadsheet rows for chunks of shoppers in parallel
+product_names, product_positions = product_lookups(df_products)
+shoppers = list(zip(shopper_ids, df_upcoming_shoppers.name.tolist(), df_upcoming_shoppers.email.tolist()))
+chunks = [shoppers[start:start + RECS_CHUNK_SIZE] for start in range(0, len(shoppers), RECS_CHUNK_SIZE)]
+chunk_args = [(chunk, {id : rec_dicts[id] for id, _, _ in chunk}, product_names, product_positions) for chunk in chunks]
+if RECS_WORKERS > 1 and len(chunks) > 1:
+    with ProcessPoolExecutor(max_workers=min(RECS_WORKERS, len(chunks)), mp_context=multiprocessing.get_context("fork")) as pool:   # Fork, so workers don't re-run this script
+        chunk_rows = list(pool.map(recommendation_rows, *zip(*chunk_args)))
+else:
+    chunk_rows = [recommendation_rows(*args) for args in chunk_args]
+
+recs_df = pd.DataFrame([row for rows in chunk_rows for row in rows],
+                       columns=['First Name', 'Last Name', 'Recipient', 'Rec Prod1', 'Rec Prod2', 'Rec Prod3', 'Rec Prod4', 'Rec Prod5'])
 recs_df['Email Sent'] = '' # Add empty 'email sent' column
+metrics.record("recommendations_dataframe", datetime.now() - start_time)
 print(f"Finished creating recommendations dataframe - Time Taken = {datetime.now() - start_time}")
 
 
 # Create new worksheet with upcoming shoppers & recommended products
-print(f"Uploading recommendations dataframe to worksheet")
-spreadsheet = client.open_by_key("1LIcZbfx_Gh_spRUAAst2doEb7bW0ZJuwR0VpRQWcUvU")
-worksheet = spreadsheet.add_worksheet(title=f"recommendations-{datetime.strftime(datetime.now().date(), '%d-%m-%Y')}", 
-                                      rows=recs_df.shape[0], cols=recs_df.shape[1])
-worksheet.update([recs_df.columns.values.tolist()] + recs_df.values.tolist())
\ No newline at end of file
+worksheet_title = f"recommendations-{datetime.strftime(datetime.now().date(), '%d-%m-%Y')}"
+start_time = datetime.now()
+if source.name == "local":
+    print(f"Saving recommendations dataframe to local storage")   # No Google Sheets access when running offline
+    csv_buffer = io.BytesIO()
+    recs_df.to_csv(csv_buffer, index=False)
+    csv_buffer.seek(0)
+    source.upload_bytes(f"{worksheet_title}.csv", csv_buffer, content_type="text/csv")
+else:
+    # Import packages to connect to Google Sheets API
+    import gspread
+    from google.oauth2.service_account import Credentials
+    import json
+    scopes = ["https://www.googleapis.com/auth/spreadsheets"]
+    secret = json.loads(os.getenv('GCP_SERVICE_ACCOUNT'))
+    creds = Credentials.from_service_account_info(secret, scopes=scopes)
+    client = gspread.authorize(creds)
+
+    print(f"Uploading recommendations dataframe to worksheet")
+    spreadsheet = client.open_by_key("1LIcZbfx_Gh_spRUAAst2doEb7bW0ZJuwR0VpRQWcUvU")
+    worksheet = spreadsheet.add_worksheet(title=worksheet_title,
+                                          rows=recs_df.shape[0] + 1, cols=recs_df.shape[1])
+    values = [recs_df.columns.values.tolist()] + recs_df.values.tolist()
+    SHEETS_CHUNK_ROWS = int(os.getenv("SHEETS_CHUNK_ROWS", 1000))
+    for start in range(0, len(values), SHEETS_CHUNK_ROWS):   # Write in chunks to stay under the Sheets API request size limits
+        worksheet.update(values=values[start:start + SHEETS_CHUNK_ROWS], range_name=f"A{start + 1}")
+metrics.record("upload", datetime.now() - start_time)
+metrics.write_report(os.getenv("TIMING_REPORT", "/tmp/recs-spreadsheet-timings.json"), job="recs-spreadsheet", shoppers=len(recs_df))
\ No newline at end of file
@@ -0,0 +1,133 @@
+# Generate a synthetic, seeded copy of the TheLook eCommerce tables for offline profiling & load tests
+# Usage: python backend/synthetic-data.py --order-items 100000 --out data/100k [--embeddings]
+import argparse
+import os
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from artifacts import EmbeddingArtifact, upload_embedding_artifact
+from data_sources import LocalSource
+from recommender import build_neighbor_table
+
+CATEGORIES = ["Jeans", "Tops & Tees", "Sweaters", "Outerwear & Coats", "Shorts", "Dresses", "Swim", "Accessories",
+              "Active", "Sleep & Lounge", "Intimates", "Socks", "Pants", "Suits & Sport Coats", "Skirts", "Blazers & Jackets"]
+BRANDS = ["Calvin Klein", "Levi's", "Carhartt", "Allegra K", "Columbia", "Nike", "Tommy Hilfiger", "Hanes", "Ray-Ban",
+          "Quiksilver", "Champion", "Patagonia", "Diesel", "Lucky Brand", "Volcom", "The North Face"]
+ADJECTIVES = ["Classic", "Slim Fit", "Relaxed", "Vintage", "Essential", "Premium", "Cotton", "Wool", "Stretch",
+              "Lightweight", "Waterproof", "Fleece", "Striped", "Printed", "Cropped", "Oversized"]
+FIRST_NAMES = ["James", "Mary", "John", "Patricia", "Robert", "Jennifer", "Michael", "Linda", "David", "Elizabeth",
+               "William", "Barbara", "Richard", "Susan", "Joseph", "Jessica", "Thomas", "Sarah", "Eric", "Karen"]
+LAST_NAMES = ["Smith", "Johnson", "Williams", "Brown", "Jones", "Garcia", "Miller", "Davis", "Rodriguez", "Martinez",
+              "Hernandez", "Lopez", "Wilson", "Anderson", "Thomas", "Taylor", "Moore", "Jackson", "Martin", "Carpenter"]
+COUNTRIES = ["China", "United States", "Brasil", "South Korea", "France", "United Kingdom", "Germany", "Spain",
+             "Japan", "Australia", "Belgium", "Poland", "Colombia", "Austria"]
+STATUSES = ["Complete", "Shipped", "Processing", "Cancelled", "Returned"]
+STATUS_PROBS = [0.25, 0.30, 0.20, 0.15, 0.10]
+
+
+def generate_products(rng, n_products : int):
+    category = rng.choice(CATEGORIES, n_products)
+    brand = rng.choice(BRANDS, n_products)
+    name = np.char.add(np.char.add(np.char.add(np.char.add(brand, " "), rng.choice(ADJECTIVES, n_products)), " "), category)
+    retail_price = np.round(rng.lognormal(3.5, 0.7, n_products), 2)
+    return pd.DataFrame({'id' : np.arange(1, n_products + 1),
+                         'cost' : np.round(retail_price * rng.uniform(0.3, 0.6, n_products), 2),
+                         'category' : category,
+                         'name' : name,
+                         'brand' : brand,
+                         'retail_price' : retail_price,
+                         'department' : rng.choice(["Men", "Women"], n_products),
+                         'sku' : [f"{x:032x}" for x in rng.integers(0, 2**62, n_products)],
+                         'distribution_center_id' : rng.integers(1, 11, n_products)})
+
+
+def generate_users(rng, n_users : int, start : np.datetime64, end : np.datetime64):
+    first_name = rng.choice(FIRST_NAMES, n_users)
+    last_name = rng.choice(LAST_NAMES, n_users)
+    ids = np.arange(1, n_users + 1)
+    email = np.char.add(np.char.add(np.char.add(np.char.lower(first_name), np.char.lower(last_name)), ids.astype(str)), "@example.com")
+    return pd.DataFrame({'id' : ids,
+                         'first_name' : first_name,
+                         'last_name' : last_name,
+                         'email' : email,
+                         'age' : rng.integers(12, 71, n_users),
+                         'gender' : rng.choice(["M", "F"], n_users),
+                         'country' : rng.choice(COUNTRIES, n_users, p=np.linspace(2, 0.1, len(COUNTRIES)) / np.linspace(2, 0.1, len(COUNTRIES)).sum()),
+                         'traffic_source' : rng.choice(["Search", "Organic", "Facebook", "Email", "Display"], n_users),
+                         'created_at' : pd.to_datetime(rng.integers(start.astype('int64'), end.astype('int64'), n_users), unit='s', utc=True)})
+
+
+def generate_orders(rng, n_orders : int, users, start : np.datetime64, end : np.datetime64):
+    # A few heavy shoppers & many one-off shoppers, like the real data
+    user_weights = rng.pareto(1.5, len(users)) + 1
+    user_id = rng.choice(users.id.values, n_orders, p=user_weights / user_weights.sum())
+    created_at = np.sort(rng.integers(start.astype('int64'), end.astype('int64'), n_orders))
+    return pd.DataFrame({'order_id' : np.arange(1, n_orders + 1),
+                         'user_id' : user_id,
+                         'status' : rng.choice(STATUSES, n_orders, p=STATUS_PROBS),
+                         'gender' : users.gender.values[user_id - 1],
+                         'created_at' : pd.to_datetime(created_at, unit='s', utc=True),
+                         'num_of_item' : 0})
+
+
+def generate_order_items(rng, n_order_items : int, orders, products):
+    # Every order has at least one item, the remaining items are spread randomly over orders
+    order_rows = np.concatenate([np.arange(len(orders)), rng.integers(0, len(orders), n_order_items - len(orders))])
+    order_rows.sort()
+    product_weights = rng.pareto(1.2, len(products)) + 1
+    product_id = rng.choice(products.id.values, n_order_items, p=product_weights / product_weights.sum())
+    orders['num_of_item'] = np.bincount(order_rows, minlength=len(orders))
+    return pd.DataFrame({'id' : np.arange(1, n_order_items + 1),
+                         'order_id' : orders.order_id.values[order_rows],
+                         'user_id' : orders.user_id.values[order_rows],
+                         'product_id' : product_id,
+                         'inventory_item_id' : np.arange(1, n_order_items + 1),
+                         'status' : orders.status.values[order_rows],
+                         'created_at' : orders.created_at.values[order_rows],
+                         'sale_price' : products.retail_price.values[product_id - 1]})
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description="Generate synthetic TheLook tables as Parquet files")
+    parser.add_argument("--order-items", type=int, default=180_000, help="number of order items (10k - 10M)")
+    parser.add_argument("--products", type=int, default=None, help="catalog size. Default: scaled from order items, at most 29,120 like TheLook")
+    parser.add_argument("--users", type=int, default=None, help="number of users. Default: 55%% of order items")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default="data")
+    parser.add_argument("--embeddings", action="store_true", help="also write random product embeddings & neighbors, so the API runs without re-encoding the catalog")
+    parser.add_argument("--model-name", default="all-mpnet-base-v2", help="model name written in the embeddings artifact")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    n_products = args.products or int(min(29_120, max(1_000, args.order_items * 0.16)))
+    n_users = args.users or max(100, int(args.order_items * 0.55))
+    n_orders = max(1, int(args.order_items * 0.69))
+    end = np.datetime64("2025-01-01T00:00:00").astype("datetime64[s]")
+    start = end - np.timedelta64(4 * 365, "D").astype("timedelta64[s]")
+
+    start_time = datetime.now()
+    print(f"Generating {n_products} products, {n_users} users, {n_orders} orders & {args.order_items} order items (seed={args.seed})...")
+    df_products = generate_products(rng, n_products)
+    df_users = generate_users(rng, n_users, start, end)
+    df_orders = generate_orders(rng, n_orders, df_users, start, end)
+    df_order_items = generate_order_items(rng, args.order_items, df_orders, df_products)
+
+    os.makedirs(args.out, exist_ok=True)
+    for table, df in [("products", df_products), ("users", df_users), ("orders", df_orders), ("order_items", df_order_items)]:
+        df.to_parquet(os.path.join(args.out, f"{table}.parquet"), index=False)
+    print(f"Finished writing tables to {args.out} - Time Taken = {datetime.now() - start_time}")
+
+    if args.embeddings:
+        start_time = datetime.now()
+        print(f"Generating random product embeddings & neighbors...")
+        embeddings = rng.standard_normal((n_products, 768), dtype=np.float32)
+        embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)   # Unit length, like all-mpnet-base-v2
+        source = LocalSource(args.out)
+        artifact_dir = os.path.join(args.out, "artifacts")
+        os.makedirs(artifact_dir, exist_ok=True)
+        EmbeddingArtifact(df_products.id.values, df_products.name.to_list(), embeddings, args.model_name).save(os.path.join(artifact_dir, f"product_embeddings_{args.model_name}"))
+        upload_embedding_artifact(source, artifact_dir, args.model_name)
+        build_neighbor_table(embeddings, df_products.id.values, k=5).to_csv(os.path.join(source.blob_dir, f"product_neighbors_{args.model_name}.csv"), index=False)
+        print(f"Finished writing embeddings to {source.blob_dir} - Time Taken = {datetime.now() - start_time}")
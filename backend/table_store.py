@@ -0,0 +1,188 @@
+# Import packages to share compact, read-only tables between API worker processes
+import fcntl
+import json
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+
+@contextmanager
+def file_lock(path : str):
+    """Exclusive lock on `path` shared by every process, held in the file `<path>.lock`"""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path + ".lock", "w") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+@contextmanager
+def atomic_path(path : str):
+    """Uniquely named temporary path next to `path`, moved over `path` once written. Concurrent writers never share a
+    temporary file, and processes that mapped the previous file keep reading it since its inode is only unlinked
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix=os.path.basename(path) + ".", suffix=".tmp")
+    os.close(fd)
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _is_string(values):
+    return isinstance(values.dtype, pd.StringDtype) or (pd.api.types.is_object_dtype(values) and pd.api.types.infer_dtype(values, skipna=True) == 'string')
+
+
+def compact_frame(df, columns : list):
+    """Keep only `columns`, downcast integer columns to int32 where the values fit & store repeated strings as
+    categoricals so every distinct string is held once (names, brands, countries, ...). Mostly unique strings (emails)
+    stay plain strings, which `TableStore` shares as one byte buffer instead of a category list per worker
+    """
+    compact = {}
+    for column in columns:
+        values = df[column]
+        if pd.api.types.is_integer_dtype(values) and not values.hasnans and (len(values) == 0 or
+                np.iinfo(np.int32).min <= values.min() and values.max() <= np.iinfo(np.int32).max):
+            values = values.astype(np.int32)
+        elif pd.api.types.is_integer_dtype(values) and values.hasnans:
+            values = values.astype(np.float64)   # Nullable integers with missing values, stored as NaN
+        elif _is_string(values) and values.nunique() <= len(values) // 2:
+            values = values.astype('category')
+        compact[column] = values.reset_index(drop=True)
+    return pd.DataFrame(compact)
+
+
+class TableStore:
+    """Arrays & DataFrames stored column by column as `.npy` files, memory-mapped read-only by every process.
+
+    One process writes the store under an exclusive file lock while the others wait, then every process attaches to
+    the same files so the operating system keeps a single copy of the data in the page cache. Categorical columns are
+    stored as integer codes plus their categories, string columns as Arrow UTF-8 bytes, offsets & validity bitmap read
+    back as Arrow-backed strings without copying, datetime columns as UTC datetime64 values.
+    """
+    MANIFEST = "manifest.json"
+
+    def __init__(self, directory : str):
+        self.directory = directory
+        self._manifest = {"arrays" : [], "frames" : {}, "metadata" : {}}
+
+    def lock(self):
+        """Exclusive lock shared by every process using this store"""
+        return file_lock(self.directory)
+
+    @property
+    def complete(self):
+        """Whether the store was fully written, the manifest is written last"""
+        return os.path.exists(os.path.join(self.directory, self.MANIFEST))
+
+    def _save(self, name : str, array):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, name + ".npy"), "wb") as f:
+            np.save(f, np.ascontiguousarray(array), allow_pickle=False)
+
+    def _load(self, name : str):
+        return np.load(os.path.join(self.directory, name + ".npy"), mmap_mode="r", allow_pickle=False)
+
+    def put_array(self, name : str, array):
+        self._save(name, array)
+        self._manifest["arrays"].append(name)
+
+    def put_frame(self, name : str, df):
+        columns = []
+        for i, column in enumerate(df.columns):
+            values = df[column]
+            prefix = f"{name}.{i}"
+            if isinstance(values.dtype, pd.CategoricalDtype):
+                self._save(prefix + ".codes", values.cat.codes.values)
+                self._save(prefix + ".categories", np.asarray(values.cat.categories.astype(str), dtype=str))   # Fixed-width unicode, object arrays need pickle
+                columns.append({"name" : column, "kind" : "category"})
+            elif _is_string(values):
+                array = pa.array(values, type=pa.large_string(), from_pandas=True)
+                offsets = np.frombuffer(array.buffers()[1], dtype=np.int64)[:len(array) + 1]
+                self._save(prefix + ".offsets", offsets)
+                self._save(prefix + ".data", np.frombuffer(array.buffers()[2], dtype=np.uint8)[:offsets[-1]])
+                self._save(prefix + ".valid", np.packbits(values.notna().values, bitorder="little"))   # Arrow validity bitmap
+                columns.append({"name" : column, "kind" : "strings", "null_count" : int(array.null_count)})
+            elif isinstance(values.dtype, pd.DatetimeTZDtype):
+                self._save(prefix, values.dt.tz_convert("UTC").dt.tz_localize(None).values)
+                columns.append({"name" : column, "kind" : "datetime", "tz" : "UTC"})
+            else:
+                self._save(prefix, values.to_numpy())
+                columns.append({"name" : column, "kind" : "values"})
+        self._manifest["frames"][name] = columns
+
+    def put_metadata(self, **metadata):
+        self._manifest["metadata"].update(metadata)
+
+    def commit(self):
+        """Write the manifest, which marks the store as complete"""
+        with open(os.path.join(self.directory, self.MANIFEST + ".tmp"), "w") as f:
+            json.dump(self._manifest, f)
+        os.replace(os.path.join(self.directory, self.MANIFEST + ".tmp"), os.path.join(self.directory, self.MANIFEST))
+
+    def attach(self):
+        """Read the manifest of a complete store, so its arrays & frames can be read"""
+        with open(os.path.join(self.directory, self.MANIFEST)) as f:
+            self._manifest = json.load(f)
+        return self
+
+    @property
+    def metadata(self):
+        return self._manifest["metadata"]
+
+    def array(self, name : str):
+        """Memory-mapped read-only array"""
+        return self._load(name)
+
+    def frame(self, name : str):
+        """DataFrame whose numeric, string & categorical code columns are memory-mapped read-only"""
+        columns = {}
+        for i, column in enumerate(self._manifest["frames"][name]):
+            prefix = f"{name}.{i}"
+            if column["kind"] == "category":
+                columns[column["name"]] = pd.Categorical.from_codes(self._load(prefix + ".codes"), categories=self._load(prefix + ".categories"))
+            elif column["kind"] == "strings":
+                offsets = self._load(prefix + ".offsets")
+                array = pa.LargeStringArray.from_buffers(len(offsets) - 1, pa.py_buffer(offsets), pa.py_buffer(self._load(prefix + ".data")),
+                                                         pa.py_buffer(self._load(prefix + ".valid")), column["null_count"])
+                columns[column["name"]] = pd.arrays.ArrowStringArray(pa.chunked_array([array]))   # Wraps the memory-mapped buffers
+            elif column["kind"] == "datetime":
+                columns[column["name"]] = pd.DatetimeIndex(self._load(prefix)).tz_localize(column["tz"])
+            else:
+                columns[column["name"]] = self._load(prefix)
+        return pd.DataFrame(columns, copy=False)
+
+
+def _remove_store(path : str):
+    shutil.rmtree(path, ignore_errors=True)   # Processes that still map the files keep reading them until they unmap them
+    if os.path.exists(path + ".lock"):
+        os.remove(path + ".lock")
+
+
+def prune_stores(parent : str, keep : str):
+    """Delete the stores in `parent` named `server-<pid>-<generation>` that were left behind by servers that are no longer
+    running, or that hold an older data generation of the server keeping `keep`
+    """
+    for name in os.listdir(parent) if os.path.isdir(parent) else []:
+        path = os.path.join(parent, name)
+        if name == keep or not name.startswith("server-") or not os.path.isdir(path):
+            continue
+        if name.split("-")[1] == keep.split("-")[1]:   # Older generation of the same server
+            _remove_store(path)
+            continue
+        try:
+            os.kill(int(name.split("-")[1]), 0)   # Signal 0 only checks that the process exists
+        except (ValueError, ProcessLookupError):
+            _remove_store(path)
+        except PermissionError:
+            pass
@@ -1,18 +1,25 @@
 import React, { useEffect, useState } from 'react';
 import api from '../api';
 
+const PAGE_SIZE = 50;
+
 const UpcomingShoppersList = () => {
 
     const [shoppers, setShoppers] = useState([]);
+    const [nextCursor, setNextCursor] = useState(null);
+    const [total, setTotal] = useState(0);
     const [loading, setLoading] = useState(false);
 
-    const fetchShoppers = async () => {
+    const fetchShoppers = async (cursor = null) => {
         try {
             setLoading(true);  // Start loading before API call
-            const response = await api.get('/upcoming-shoppers');
-            setShoppers(response.data.shoppers);
+            const params = cursor ? { limit: PAGE_SIZE, cursor } : { limit: PAGE_SIZE };
+            const response = await api.get('/upcoming-shoppers', { params });
+            setShoppers((previous) => cursor ? [...previous, ...response.data.shoppers] : response.data.shoppers);
+            setNextCursor(response.data.next_cursor);
+            setTotal(response.data.total);
         } catch (error) {
-          console.error("Error Recommending Products", error);
+          console.error("Error Fetching Upcoming Shoppers", error);
         } finally {
           setLoading(false); // Stop loading after API call completes
         }
@@ -26,20 +33,28 @@ const UpcomingShoppersList = () => {
         <div>
         <h2>Upcoming Shoppers</h2>
 
-        {loading ? ( // Show loading state while fetching
+        {loading && shoppers.length === 0 ? ( // Show loading state while fetching the first page
         <p>Loading...</p>
         ) : shoppers.length === 0 ? ( // Show message only after search
         <p>No Upcoming Shoppers were predicted.</p>
         ) : (
+        <>
+        <p>Showing {shoppers.length} of {total} upcoming shoppers</p>
         <ul>
-          {shoppers.map((shopper, index) => (
-            <li key={index}>{shopper.shopper_id} | {shopper.name} | {shopper.email} | ${shopper.pred_equity}</li>
+          {shoppers.map((shopper) => (
+            <li key={shopper.shopper_id}>{shopper.shopper_id} | {shopper.name} | {shopper.email} | ${shopper.pred_equity}</li>
           ))}
         </ul>
+        {nextCursor && (
+          <button onClick={() => fetchShoppers(nextCursor)} disabled={loading}>
+            {loading ? 'Loading...' : 'Load more'}
+          </button>
+        )}
+        </>
         )}
         </div>
       );
 
 };
 
-export default UpcomingShoppersList;
\ No newline at end of file
+export default UpcomingShoppersList;